@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+apc_cache.py
+Cache of the per-trace HMM fits of a movie. Each trace is keyed by a hash of its float32
+intensities together with the engine and the initial parameters, so a re-run with other
+cutoffs only fits the traces whose inputs changed. The state paths are stored run-length
+encoded in one compressed .npz file per movie, which keeps the fits of earlier runs too,
+up to a maximum number of traces.
+
+"""
+from __future__ import division, print_function, absolute_import
+import hashlib
+import numpy as np
+from pathlib import Path
+from apc_pool import outputs
+from apc_hmm import state_rmsd
+
+
+def trace_keys(trace, *param):
+    """ Hash of each trace with the fit parameters
+    Args:
+        trace: Traces [spot, frame]
+        param: Engine name and initial parameters, anything with a stable repr or array
+
+    Returns:
+        Keys [spot] as 20-byte strings
+    """
+    h = hashlib.sha1()
+    for p in param:
+        h.update(np.asarray(p).tobytes() if isinstance(p, np.ndarray) else repr(p).encode())
+    prefix = h.digest()
+    trace = np.ascontiguousarray(trace, dtype=np.float32)
+    return np.array([hashlib.sha1(prefix + t.tobytes()).digest() for t in trace], dtype='S20')
+
+
+def rle_encode(state):
+    """ Run-length encoding of state paths
+    Args:
+        state: State paths [spot, frame]
+
+    Returns:
+        offset: Index of the first run of each path in the run arrays [spot+1]
+        start, length, level: Runs of all paths, concatenated [run]
+    """
+    state = np.asarray(state)
+    n_spot, n_frame = state.shape
+    is_start = np.ones(state.shape, dtype=bool)
+    is_start[:,1:] = state[:,1:] != state[:,:-1]
+    spot, start = np.nonzero(is_start)
+    end = np.append(start[1:], n_frame)
+    end[np.append(spot[1:] != spot[:-1], True)] = n_frame
+    offset = np.searchsorted(spot, np.arange(n_spot+1))
+    return offset, start, end - start, state[spot, start]
+
+
+def rle_decode(offset, start, length, level, n_frame):
+    """ State paths from their run-length encoding
+    Args:
+        offset, start, length, level: As returned by rle_encode
+        n_frame: Number of frames
+
+    Returns:
+        State paths [spot, frame]
+    """
+    n_spot = len(offset) - 1
+    spot = np.repeat(np.arange(n_spot), np.diff(offset))
+    state = np.zeros((n_spot, n_frame), dtype=level.dtype if len(level) else np.uint8)
+    index = np.repeat(spot*n_frame + start, length) + (np.arange(length.sum()) - np.repeat(np.cumsum(length) - length, length))
+    state.flat[index] = np.repeat(level, length)
+    return state
+
+
+class FitCache:
+    """ Per-trace fit results of a movie, keyed by trace_keys
+    """
+    # Per-trace fields stored besides the state path
+    fields = ['I_u', 'I_b', 'covars', 'transmat', 'log_likelihood', 'n_iter', 'converged']
+
+    def __init__(self, path, max_size=100000):
+        """
+        Args:
+            path: Cache file
+            max_size: Maximum number of traces kept in the file
+        """
+        self.path = Path(path)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.keys = np.zeros(0, dtype='S20')
+        self.data = {}
+        self.n_frame = 0
+        if self.path.exists():
+            with np.load(self.path) as f:
+                self.keys = f['keys']
+                self.n_frame = int(f['n_frame'])
+                self.data = {key: f[key] for key in f.files if key not in ['keys', 'n_frame']}
+        self.index = {k: i for i, k in enumerate(self.keys)}
+
+    def lookup(self, keys):
+        """ Position of each key in the cache, -1 if missing. Counts hits and misses.
+        """
+        index = np.array([self.index.get(k, -1) for k in keys], dtype=int)
+        self.hits += int(np.sum(index >= 0))
+        self.misses += int(np.sum(index < 0))
+        return index
+
+    def runs(self, index):
+        """ Runs of the cached paths at index
+        Returns:
+            offset: Index of the first run of each path in the selected runs [len(index)+1]
+            run: Positions of the selected runs in the run arrays [run]
+        """
+        d = self.data
+        first, last = d['offset'][index], d['offset'][index+1]
+        run = [np.arange(i, j) for i, j in zip(first, last)]
+        run = np.concatenate(run) if run else np.zeros(0, dtype=int)
+        return np.append(0, np.cumsum(last - first)), run
+
+    def get(self, index, trace):
+        """ Fit results of cached traces, as returned by apc_pool.fit_traces_parallel
+        Args:
+            index: Positions in the cache [spot]
+            trace: The traces [spot, frame], to compute rmsd
+
+        Returns:
+            Dictionary of results
+        """
+        d = self.data
+        offset, run = self.runs(index)
+        state = rle_decode(offset, d['start'][run], d['length'][run], d['level'][run], self.n_frame)
+        result = {key: d[key][index] for key in self.fields}
+        result['state'] = state
+        result['rmsd'] = state_rmsd(trace, np.column_stack((result['I_u'], result['I_b'])), state)
+        return result
+
+    def save(self, keys, result):
+        """ Write the results of the current traces, followed by the cached traces not among
+        them (most recent first) up to max_size traces in all
+        Args:
+            keys: Keys of the traces [spot]
+            result: Fit results of the traces, with state [spot, frame]
+        """
+        offset, start, length, level = rle_encode(result['state'])
+        n_frame = result['state'].shape[1]
+        data = {'offset': offset, 'start': start, 'length': length, 'level': level}
+        data.update({key: result[key] for key in self.fields})
+
+        # Keep the other traces of earlier runs on the same frames
+        if self.n_frame == n_frame and len(self.keys):
+            keep = np.flatnonzero(~np.isin(self.keys, keys))[:max(self.max_size - len(keys), 0)]
+            old_offset, run = self.runs(keep)
+            keys = np.concatenate((keys, self.keys[keep]))
+            data['offset'] = np.append(offset[:-1], offset[-1] + old_offset)
+            for key in ['start', 'length', 'level']:
+                data[key] = np.concatenate((data[key], self.data[key][run]))
+            for key in self.fields:
+                data[key] = np.concatenate((data[key], self.data[key][keep]))
+
+        np.savez_compressed(self.path, keys=keys, n_frame=n_frame, offset=data['offset'], start=data['start'].astype(np.int32),
+                            length=data['length'].astype(np.int32), level=data['level'].astype(np.uint8),
+                            **{key: data[key] for key in self.fields})
+
+
+def fit_traces_cached(path, trace, fit, *param, max_size=100000):
+    """ Fit only the traces that are not in the cache
+    Args:
+        path: Cache file of the movie
+        trace: Traces [spot, frame]
+        fit: Function fitting a subset of traces [spot, frame] into a dictionary of results,
+             e.g. a partial of apc_pool.fit_traces_parallel
+        param: Engine name and initial parameters, part of the keys
+        max_size: Maximum number of traces kept in the cache
+
+    Returns:
+        result: Dictionary of results of all traces. Results of fit not kept in the cache,
+                e.g. fit_time, are zero for the cached traces.
+        hits, misses: Number of traces found in and missing from the cache
+    """
+    if len(trace) == 0:
+        n_frame = np.shape(trace)[1] if np.ndim(trace) == 2 else 0
+        result = {name: np.zeros((0,) + tuple(n_frame if n < 0 else n for n in shape), dtype=dtype)
+                  for name, dtype, shape in outputs}
+        return result, 0, 0
+
+    cache = FitCache(path, max_size)
+    keys = trace_keys(trace, *param)
+    index = cache.lookup(keys)
+    hit = index >= 0
+    if cache.n_frame != trace.shape[1]:
+        hit[:] = False
+        cache.hits, cache.misses = 0, len(keys)
+
+    new = fit(trace[~hit]) if np.any(~hit) else None
+    old = cache.get(index[hit], trace[hit]) if np.any(hit) else None
+    result = {}
+    names = ['state', 'rmsd'] + FitCache.fields
+    if new is not None:
+        names += [key for key in new if key not in names]
+    for key in names:
+        ref = new if new is not None else old
+        result[key] = np.zeros((len(trace),) + ref[key].shape[1:], dtype=ref[key].dtype)
+        if new is not None:
+            result[key][~hit] = new[key]
+        if old is not None and key in old:
+            result[key][hit] = old[key]
+    cache.save(keys, result)
+    return result, cache.hits, cache.misses
@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+"""
+apc_drift.py
+Stage drift estimation for the time-lapse movies. The functions here return the
+translation of each frame relative to a reference frame, in the same (row, col)
+convention as imreg_dft, i.e. np.roll(I_frame, tvec) overlays I_frame on I_ref.
+
+"""
+from __future__ import division, print_function, absolute_import
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from scipy.interpolate import CubicSpline
+from imreg_dft.imreg import translation
+
+
+def register_translation(I_ref, I_frame):
+    """ Translation of a frame relative to the reference frame (imreg_dft)
+    Args:
+        I_ref: Reference image [row, col]
+        I_frame: Image to register [row, col]
+
+    Returns:
+        Translation vector (row, col) in pixels
+    """
+    result = translation(I_ref, I_frame)
+    return np.asarray(result['tvec'], dtype=float)
+
+
+def register_frames(I_ref, I, workers=1, register=register_translation):
+    """ Translation of each frame relative to the reference frame
+    The FFTs release the GIL, so the frames are registered concurrently on a thread 
+    pool if workers > 1. The results are returned in frame order.
+
+    Args:
+        I_ref: Reference image [row, col]
+        I: Frames to register [frame, row, col], or a list of images
+        workers: Number of threads
+        register: Function returning the translation of a frame against I_ref
+
+    Returns:
+        Translation of each frame [frame, 2]
+    """
+    if workers > 1 and len(I) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            tvec = list(pool.map(lambda I_frame: register(I_ref, I_frame), I))
+    else:
+        tvec = [register(I_ref, I_frame) for I_frame in I]
+    return np.reshape(np.array(tvec, dtype=float), (len(I), 2))
+
+
+def keyframe_image(I, i, k, k_sum):
+    """ Image used to register the keyframe i
+    Args:
+        I: Movie [frame, row, col]
+        i: Keyframe index
+        k: Spacing between keyframes
+        k_sum: If True, average the k frames centered at i for better SNR
+
+    Returns:
+        Single frame or the mean of the frames around the keyframe
+    """
+    if not k_sum or k < 2:
+        return I[i]
+    h = int(k/2)
+    return np.mean(I[max(0, i-h):min(len(I), i+k-h)], axis=0)
+
+
+def interpolate_drift(key, tvec, n_frame):
+    """ Interpolate the drift measured at the keyframes to all frames
+    Args:
+        key: Sorted keyframe indices
+        tvec: Translation at each keyframe [key, 2]
+        n_frame: Number of frames
+
+    Returns:
+        Translation of every frame [frame, 2] as float
+    """
+    t = np.arange(n_frame)
+    tvec = np.asarray(tvec, dtype=float)
+    if len(key) < 4: # Too few knots for a cubic spline
+        return np.stack([np.interp(t, key, tvec[:,j]) for j in range(2)], axis=1)
+    return CubicSpline(key, tvec, axis=0)(t)
+
+
+def keyframe_drift(I, I_ref, k=20, k_sum=False, max_step=1.0, register=register_translation, workers=1):
+    """ Drift registered at every k-th frame and interpolated in between.
+    Keyframe spacing adapts to the drift velocity: an interval is halved until the
+    drift between its two keyframes is below max_step, so the spline never has to
+    bridge more than about one pixel of motion.
+
+    Args:
+        I: Movie [frame, row, col]
+        I_ref: Reference image [row, col]
+        k: Initial spacing between keyframes
+        k_sum: If True, register the mean of the frames around each keyframe
+        max_step: Maximum drift [pixel] between neighboring keyframes
+        register: Function returning the translation of a frame against I_ref
+        workers: Number of threads used to register the keyframes
+
+    Returns:
+        d_row, d_col: Translation of every frame as float
+        key: Keyframe indices that were registered
+    """
+    n_frame = len(I)
+    k = max(1, int(k))
+
+    # First and last frames are always keyframes so that nothing is extrapolated
+    key = list(range(0, n_frame, k))
+    if key[-1] != n_frame-1:
+        key.append(n_frame-1)
+    d = register_frames(I_ref, [keyframe_image(I, i, k, k_sum) for i in key], workers, register)
+    tvec = dict(zip(key, d))
+
+    # Register the middle of every interval that drifted too fast
+    while True:
+        key = sorted(tvec)
+        new = [(a, b) for a, b in zip(key[:-1], key[1:])
+               if b-a > 1 and np.max(np.abs(tvec[b]-tvec[a])) > max_step]
+        if not new:
+            break
+        mid = [int((a+b)/2) for a, b in new]
+        image = [keyframe_image(I, i, int((b-a)/2), k_sum) for i, (a, b) in zip(mid, new)]
+        tvec.update(zip(mid, register_frames(I_ref, image, workers, register)))
+
+    key = sorted(tvec)
+    d = interpolate_drift(key, [tvec[i] for i in key], n_frame)
+    return d[:,0], d[:,1], np.array(key)
+
+
+def bin_image(I, m):
+    """ Downsample an image by averaging m x m blocks
+    Args:
+        I: Image [row, col]
+        m: Bin size
+
+    Returns:
+        Binned image [row/m, col/m]
+    """
+    n_row = int(I.shape[0]/m)*m
+    n_col = int(I.shape[1]/m)*m
+    return I[:n_row,:n_col].reshape(int(n_row/m), m, int(n_col/m), m).mean(axis=(1, 3))
+
+
+def window_correlation(I_ref, I_frame, center, w, roi=0.5):
+    """ Normalized cross-correlation by direct sums over the shifts center +/- w.
+    Only the central roi fraction of the image is compared, and the ROI is shrunk if
+    needed so that every shifted window stays inside the frame.
+
+    Args:
+        I_ref: Reference image [row, col]
+        I_frame: Image to register [row, col]
+        center: Integer shift (row, col) at the center of the search window
+        w: Half width of the search window [pixel]
+        roi: Fraction of the image size used as the central ROI
+
+    Returns:
+        Correlation surface [2w+1, 2w+1], or None if the ROI does not fit
+    """
+    n_row, n_col = I_ref.shape
+    c_row, c_col = int(center[0]), int(center[1])
+    h_row = min(int(n_row*roi/2), int(n_row/2)-abs(c_row)-w-1)
+    h_col = min(int(n_col*roi/2), int(n_col/2)-abs(c_col)-w-1)
+    if h_row < 2 or h_col < 2:
+        return None
+    r0, r1 = int(n_row/2)-h_row, int(n_row/2)+h_row
+    c0, c1 = int(n_col/2)-h_col, int(n_col/2)+h_col
+
+    a = np.asarray(I_ref[r0:r1,c0:c1], dtype=float)
+    a = a - a.mean()
+    a_norm = np.sqrt(np.sum(a**2))
+    n = a.size
+
+    C = np.zeros((2*w+1, 2*w+1))
+    for i in range(2*w+1):
+        dr = c_row + i - w
+        for j in range(2*w+1):
+            dc = c_col + j - w
+            b = np.asarray(I_frame[r0-dr:r1-dr,c0-dc:c1-dc], dtype=float)
+            b_var = np.sum(b**2) - np.sum(b)**2/n
+            if a_norm > 0 and b_var > 0:
+                C[i,j] = np.sum(a*b)/(a_norm*np.sqrt(b_var))
+    return C
+
+
+def register_window(I_ref, I_frame, center=(0, 0), w=3, roi=0.5, downsample=1):
+    """ Integer translation within center +/- w by direct cross-correlation.
+    With downsample = m > 1, the search runs on m x m binned images first and the
+    result is refined at full resolution within +/- m pixels.
+
+    Args:
+        I_ref: Reference image [row, col]
+        I_frame: Image to register [row, col]
+        center: Expected translation (row, col), e.g. that of the previous frame
+        w: Half width of the search window [pixel]
+        roi: Fraction of the image size used as the central ROI
+        downsample: Bin size for the coarse search
+
+    Returns:
+        tvec: Translation (row, col), or None if the window does not fit
+        peak: Correlation at tvec
+        edge: True if the peak lies on the border of the search window
+    """
+    center = np.round(center).astype(int)
+    if downsample > 1:
+        m = int(downsample)
+        w_bin = int(np.ceil(w/m))
+        C = window_correlation(bin_image(I_ref, m), bin_image(I_frame, m), np.round(center/m), w_bin, roi)
+        if C is None:
+            return None, 0., True
+        i, j = np.unravel_index(np.argmax(C), C.shape)
+        center = (np.round(center/m) + [i-w_bin, j-w_bin])*m
+        w = m
+
+    C = window_correlation(I_ref, I_frame, center, w, roi)
+    if C is None:
+        return None, 0., True
+    i, j = np.unravel_index(np.argmax(C), C.shape)
+    edge = i in (0, 2*w) or j in (0, 2*w)
+    tvec = np.array([center[0]+i-w, center[1]+j-w], dtype=float)
+    return tvec, C[i,j], edge
+
+
+def track_drift(I, I_ref, w=3, roi=0.5, downsample=1, min_corr=0.3, register=register_translation, workers=1):
+    """ Drift by windowed cross-correlation, each frame searched around the previous one.
+    The drift between consecutive frames is small (correct_drift discards steps above 
+    a few pixels anyway), so only shifts within +/- w of the previous frame's translation
+    are tested against I_ref. The full registration is used for the first frame and 
+    whenever the correlation peak is weak or lies on the border of the window.
+    With workers > 1 the movie is split into contiguous blocks, each tracked on its own
+    thread starting from a full registration of its first frame.
+
+    Args:
+        I: Movie [frame, row, col]
+        I_ref: Reference image [row, col]
+        w: Half width of the search window [pixel]
+        roi: Fraction of the image size used as the central ROI
+        downsample: Bin size for the coarse search
+        min_corr: Minimum correlation peak accepted from the windowed search
+        register: Full registration used as the fallback
+        workers: Number of threads
+
+    Returns:
+        d_row, d_col: Translation of every frame
+        fallback: True where the full registration was used
+    """
+    n_frame = len(I)
+    if workers > 1 and n_frame > 1:
+        block = np.array_split(np.arange(n_frame), min(workers, n_frame))
+        track = lambda b: track_drift(I[b[0]:b[-1]+1], I_ref, w, roi, downsample, min_corr, register)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            result = list(pool.map(track, block))
+        return tuple(np.concatenate(x) for x in zip(*result))
+
+    d = np.zeros((n_frame, 2))
+    fallback = np.zeros(n_frame, dtype=bool)
+    center = None
+    for i, I_frame in enumerate(I):
+        tvec = None
+        if center is not None:
+            tvec, peak, edge = register_window(I_ref, I_frame, center, w, roi, downsample)
+            if peak < min_corr or edge:
+                tvec = None
+        if tvec is None:
+            tvec = register(I_ref, I_frame)
+            fallback[i] = True
+        d[i] = tvec
+        center = np.round(tvec)
+    return d[:,0], d[:,1], fallback
+
+
+def correlation_quality(I_ref, I_frame, tvec, w=3, roi=0.5):
+    """ Quality of a registration from the correlation surface around its translation
+    Args:
+        I_ref: Reference image [row, col]
+        I_frame: Registered image [row, col]
+        tvec: Translation (row, col) of I_frame
+        w: Half width of the surface [pixel]
+        roi: Fraction of the image size used as the central ROI
+
+    Returns:
+        peak: Normalized correlation at the rounded translation
+        psr: Peak-to-sidelobe ratio, (peak - mean)/std of the surface outside the 3x3 peak
+    """
+    C = window_correlation(I_ref, I_frame, np.round(tvec), w, roi)
+    if C is None:
+        return np.nan, np.nan
+    peak = C[w,w]
+    sidelobe = np.ones(C.shape, dtype=bool)
+    sidelobe[w-1:w+2,w-1:w+2] = False
+    s = np.std(C[sidelobe])
+    psr = (peak - np.mean(C[sidelobe]))/s if s > 0 else np.inf
+    return peak, psr
+
+
+def drift_quality(I_ref, I, d_row, d_col, w=3, roi=0.5, workers=1):
+    """ Correlation peak and peak-to-sidelobe ratio of every registered frame
+    Args:
+        I_ref: Reference image [row, col]
+        I: Movie [frame, row, col]
+        d_row, d_col: Translation of every frame
+        w: Half width of the correlation surface [pixel]
+        roi: Fraction of the image size used as the central ROI
+        workers: Number of threads
+
+    Returns:
+        peak, psr: Arrays with one value per frame
+    """
+    quality = lambda i: correlation_quality(I_ref, I[i], (d_row[i], d_col[i]), w, roi)
+    if workers > 1 and len(I) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            q = list(pool.map(quality, range(len(I))))
+    else:
+        q = [quality(i) for i in range(len(I))]
+    q = np.reshape(np.array(q, dtype=float), (len(I), 2))
+    return q[:,0], q[:,1]
+
+
+def is_static(I_ref, I, n_probe=5, tol=0.5, register=register_translation):
+    """ Check whether the field is static from a few frames spread over the movie
+    Args:
+        I_ref: Reference image [row, col]
+        I: Movie [frame, row, col]
+        n_probe: Number of frames to register
+        tol: Maximum translation [pixel] considered as no drift
+        register: Function returning the translation of a frame against I_ref
+
+    Returns:
+        True if none of the probe frames moved by more than tol
+    """
+    probe = np.unique(np.linspace(0, len(I)-1, n_probe).astype(int))
+    tvec = register_frames(I_ref, I[probe], register=register)
+    return bool(np.all(np.abs(tvec) < tol))
@@ -26,6 +26,8 @@ from tifffile import TiffFile
 import csv
 from scipy import optimize
 from hmmlearn import hmm
+from apc_drift import register_frames
+from apc_trace import box_trace
 #import pandas as pd
 
 def read_movie1(movie_path):
@@ -162,17 +164,14 @@ def flatfield_correct2(I, bin_size):
 
     return I_bin, I_flatfield
 
-def drift_correct(I):
+def drift_correct(I, workers=1):
     I_ref = I[int(len(I)/2),] # Mid frame as a reference frame
 #    I_ref = np.max(I, axis=0)
 
-    # Translation as compared with I_ref
-    d_row = np.zeros(len(I), dtype='int')
-    d_col = np.zeros(len(I), dtype='int')
-    for i, I_frame in enumerate(I):
-        result = translation(I_ref, I_frame)
-        d_row[i] = round(result['tvec'][0])
-        d_col[i] = round(result['tvec'][1])      
+    # Translation as compared with I_ref (registered on a thread pool if workers > 1)
+    tvec = np.round(register_frames(I_ref, I, workers))
+    d_row = tvec[:,0].astype('int')
+    d_col = tvec[:,1].astype('int')
 
     # Changes of translation between the consecutive frames
     dd_row = d_row[1:] - d_row[:-1]
@@ -210,10 +209,10 @@ def reject_outliers(data, row, col):
 
 
 def get_trace(I, row, col, spot_size):  
-    r = row
-    c = col
+    # Mean in the box around (row, col). Arrays of positions give a trace per position.
     s = int((spot_size-1)/2)
-    return np.mean(np.mean(I[:,r-s:r+s+1,c-s:c+s+1], axis=2), axis=1)
+    trace = box_trace(I, np.atleast_1d(row), np.atleast_1d(col), 2*s+1)
+    return trace[0] if np.ndim(row) == 0 else trace
 
 
 def fit_trace(I_trace):
@@ -0,0 +1,626 @@
+# -*- coding: utf-8 -*-
+"""
+apc_hmm.py
+Gaussian HMM fitted to all spot traces at once. Forward-backward, Baum-Welch and
+Viterbi run in log space on the whole [spot, frame] trace matrix, each trace with its
+own parameters. The loops run over frames only, and traces that have converged are
+dropped from the following iterations. The M step follows hmmlearn's GaussianHMM
+(covars_prior, no other priors), so a trace gets the same fit as a GaussianHMM
+started from the same parameters.
+
+"""
+from __future__ import division, print_function, absolute_import
+import numpy as np
+
+
+def logsumexp(a, axis):
+    """ log(sum(exp(a))) along an axis, safe for rows of -inf
+    """
+    m = np.max(a, axis=axis, keepdims=True)
+    m[~np.isfinite(m)] = 0
+    with np.errstate(divide='ignore'):
+        return np.log(np.sum(np.exp(a - m), axis=axis)) + np.squeeze(m, axis=axis)
+
+
+def log_emission(X, means, covars):
+    """ Gaussian log likelihood of each frame in each state
+    Args:
+        X: Traces [spot, frame]
+        means, covars: State means and variances [spot, state]
+
+    Returns:
+        log_B [spot, frame, state]
+    """
+    return (-0.5*np.log(2*np.pi*covars)[:,None,:]
+            - (X[:,:,None] - means[:,None,:])**2/(2*covars[:,None,:]))
+
+
+def forward_backward(log_B, log_startprob, log_transmat, chunk=256):
+    """ State posteriors and summed transition posteriors
+    Args:
+        log_B: Emission log likelihood [spot, frame, state]
+        log_startprob: [spot, state]
+        log_transmat: [spot, state, state]
+        chunk: Number of frames per block when summing the transition posteriors
+
+    Returns:
+        gamma: Posterior of each state [spot, frame, state]
+        xi_sum: Posterior number of transitions i -> j [spot, state, state]
+        log_likelihood: [spot]
+    """
+    N, T, K = log_B.shape
+    log_alpha = np.empty((N, T, K))
+    log_alpha[:,0] = log_startprob + log_B[:,0]
+    for t in range(1, T):
+        log_alpha[:,t] = log_B[:,t] + logsumexp(log_alpha[:,t-1,:,None] + log_transmat, axis=1)
+
+    log_beta = np.zeros((N, T, K))
+    for t in range(T-2, -1, -1):
+        log_beta[:,t] = logsumexp(log_transmat + (log_B[:,t+1] + log_beta[:,t+1])[:,None,:], axis=2)
+
+    log_likelihood = logsumexp(log_alpha[:,-1], axis=1)
+    gamma = np.exp(log_alpha + log_beta - log_likelihood[:,None,None])
+
+    xi_sum = np.zeros((N, K, K))
+    for t0 in range(0, T-1, chunk):
+        t1 = min(t0+chunk, T-1)
+        log_xi = (log_alpha[:,t0:t1,:,None] + log_transmat[:,None]
+                  + (log_B[:,t0+1:t1+1] + log_beta[:,t0+1:t1+1])[:,:,None,:]
+                  - log_likelihood[:,None,None,None])
+        xi_sum += np.exp(log_xi).sum(axis=1)
+    return gamma, xi_sum, log_likelihood
+
+
+def viterbi(log_B, log_startprob, log_transmat):
+    """ Most likely state sequence of each trace
+    Args:
+        log_B: Emission log likelihood [spot, frame, state]
+        log_startprob: [spot, state]
+        log_transmat: [spot, state, state]
+
+    Returns:
+        state: [spot, frame]
+        log_prob: Log probability of the state sequence [spot]
+    """
+    N, T, K = log_B.shape
+    back = np.empty((N, T, K), dtype=np.uint8)
+    delta = log_startprob + log_B[:,0]
+    for t in range(1, T):
+        score = delta[:,:,None] + log_transmat
+        back[:,t] = np.argmax(score, axis=1)
+        delta = np.take_along_axis(score, back[:,t,None,:].astype(int), axis=1)[:,0] + log_B[:,t]
+
+    state = np.empty((N, T), dtype=int)
+    state[:,-1] = np.argmax(delta, axis=1)
+    log_prob = delta[np.arange(N), state[:,-1]]
+    for t in range(T-1, 0, -1):
+        state[:,t-1] = back[np.arange(N), t, state[:,t]]
+    return state, log_prob
+
+
+def _log(p):
+    with np.errstate(divide='ignore'):
+        return np.log(p)
+
+
+def init_model(n_spot, startprob, transmat, means, covars):
+    """ Per-trace parameters, broadcasting shared ones to all traces
+    Args:
+        n_spot: Number of traces
+        startprob: [state] or [spot, state]
+        transmat: [state, state] or [spot, state, state]
+        means, covars: [state] or [spot, state]
+
+    Returns:
+        Model dictionary with startprob, transmat, means, covars
+    """
+    K = np.shape(means)[-1]
+    return {'startprob': np.array(np.broadcast_to(startprob, (n_spot, K)), dtype=float),
+            'transmat': np.array(np.broadcast_to(transmat, (n_spot, K, K)), dtype=float),
+            'means': np.array(np.broadcast_to(means, (n_spot, K)), dtype=float),
+            'covars': np.array(np.broadcast_to(covars, (n_spot, K)), dtype=float)}
+
+
+def e_step(X, model):
+    """ Forward-backward with the current parameters
+    """
+    log_B = log_emission(X, model['means'], model['covars'])
+    return forward_backward(log_B, _log(model['startprob']), _log(model['transmat']))
+
+
+def m_step(X, model, gamma, xi_sum, covars_prior=1e-2):
+    """ Baum-Welch update of the parameters in place, as GaussianHMM (covariance_type='full').
+    States without posterior weight keep their parameters.
+    """
+    post = gamma.sum(axis=1)
+    obs = np.einsum('ntk,nt->nk', gamma, X)
+    obs2 = np.einsum('ntk,nt->nk', gamma, X**2)
+
+    start = gamma[:,0]
+    model['startprob'] = start/start.sum(axis=1, keepdims=True)
+    row = xi_sum.sum(axis=2, keepdims=True)
+    model['transmat'] = np.where(row > 0, xi_sum/np.where(row > 0, row, 1), model['transmat'])
+
+    has_post = post > 0
+    safe = np.where(has_post, post, 1)
+    means = np.where(has_post, obs/safe, model['means'])
+    covars = (covars_prior + obs2 - 2*means*obs + means**2*post)/safe
+    model['means'] = means
+    model['covars'] = np.where(has_post, covars, model['covars'])
+    return model
+
+
+def fit_model(X, model, n_iter=100, tol=1e-2, covars_prior=1e-2):
+    """ Baum-Welch on all traces. A trace stops updating once its log likelihood
+    improves by less than tol, as with GaussianHMM.
+
+    Args:
+        X: Traces [spot, frame]
+        model: Initial parameters from init_model, updated in place
+        n_iter: Maximum number of iterations
+        tol: Convergence threshold of the log likelihood gain
+        covars_prior: Prior added to the variance numerator
+
+    Returns:
+        model, with also
+            log_likelihood: Log likelihood at the last E step [spot]
+            n_iter: Number of iterations run [spot]
+            converged: True if converged within n_iter [spot]
+    """
+    X = np.asarray(X, dtype=float)
+    N = len(X)
+    log_likelihood = np.full(N, -np.inf)
+    iteration = np.zeros(N, dtype=int)
+    converged = np.zeros(N, dtype=bool)
+    active = np.arange(N)
+    keys = ['startprob', 'transmat', 'means', 'covars']
+    for _ in range(n_iter):
+        if len(active) == 0:
+            break
+        sub = {key: model[key][active] for key in keys}
+        gamma, xi_sum, ll = e_step(X[active], sub)
+        m_step(X[active], sub, gamma, xi_sum, covars_prior)
+        for key in keys:
+            model[key][active] = sub[key]
+
+        iteration[active] += 1
+        done = ll - log_likelihood[active] < tol
+        log_likelihood[active] = ll
+        converged[active[done]] = True
+        active = active[~done]
+
+    model['log_likelihood'] = log_likelihood
+    model['n_iter'] = iteration
+    model['converged'] = converged
+    return model
+
+
+def decode(X, model):
+    """ Viterbi path of each trace
+    Args:
+        X: Traces [spot, frame]
+        model: Parameters
+
+    Returns:
+        state: [spot, frame]
+        log_prob: [spot]
+    """
+    X = np.asarray(X, dtype=float)
+    log_B = log_emission(X, model['means'], model['covars'])
+    return viterbi(log_B, _log(model['startprob']), _log(model['transmat']))
+
+
+def order_states(model, state=None):
+    """ Relabel the states of each trace by increasing mean (0 = unbound, 1 = bound)
+    Args:
+        model: Parameters, reordered in place
+        state: State paths [spot, frame], relabeled if given
+
+    Returns:
+        model, state
+    """
+    order = np.argsort(model['means'], axis=1, kind='stable')
+    rank = np.argsort(order, axis=1)
+    for key in ['startprob', 'means', 'covars']:
+        model[key] = np.take_along_axis(model[key], order, axis=1)
+    model['transmat'] = np.take_along_axis(np.take_along_axis(model['transmat'], order[:,:,None], axis=1),
+                                           order[:,None,:], axis=2)
+    if state is not None:
+        state = np.take_along_axis(rank, state, axis=1)
+    return model, state
+
+
+def state_rmsd(X, means, state, block=512):
+    """ Root mean square deviation of the traces from the means of their states, in blocks
+    of traces so that the fitted traces [spot, frame] are never built in full
+
+    Args:
+        X: Traces [spot, frame]
+        means: State means, shared [state] or per trace [spot, state]
+        state: State paths [spot, frame]
+        block: Number of traces per block
+
+    Returns:
+        rmsd: [spot]
+    """
+    N = len(X)
+    means = np.broadcast_to(np.asarray(means, dtype=float), (N, np.shape(means)[-1]))
+    rmsd = np.zeros(N)
+    for i0 in range(0, N, block):
+        i1 = min(i0+block, N)
+        fit = np.take_along_axis(means[i0:i1], state[i0:i1].astype(np.intp), axis=1)
+        rmsd[i0:i1] = np.mean((fit - X[i0:i1])**2, axis=1)**0.5
+    return rmsd
+
+
+def fit_path(X, model):
+    """ Decode the traces with their fitted parameters, ordered by mean
+    Args:
+        X: Traces [spot, frame]
+        model: Per-trace parameters, reordered in place
+
+    Returns:
+        model, state and rmsd as in fit_traces
+    """
+    state, _ = decode(X, model)
+    model, state = order_states(model, state)
+    return model, state.astype(np.uint8), state_rmsd(X, model['means'], state)
+
+
+def fit_traces(X, startprob, transmat, means, covars, n_iter=100, tol=1e-2):
+    """ Fit and decode every trace, as Movie.fit_spot does with one GaussianHMM per trace
+    Args:
+        X: Traces [spot, frame]
+        startprob, transmat, means, covars: Initial parameters, shared or per trace
+        n_iter: Maximum number of iterations
+        tol: Convergence threshold of the log likelihood gain
+
+    Returns:
+        model: Fitted parameters ordered by mean, with log_likelihood, n_iter, converged
+        state: Viterbi path [spot, frame] (uint8)
+        rmsd: Root mean square deviation of the trace from the mean of its state [spot]
+    """
+    X = np.asarray(X, dtype=float)
+    model = fit_model(X, init_model(len(X), startprob, transmat, means, covars), n_iter, tol)
+    return fit_path(X, model)
+
+
+def pooled_statistics(X, scale, model, covars_prior=1e-2, block=512):
+    """ E step of a model shared by all traces, summing the sufficient statistics over
+    blocks of traces
+
+    Args:
+        X: Traces [spot, frame]
+        scale: Intensity scale of each trace [spot]
+        model: Shared parameters (startprob [state], transmat [state, state], means, covars [state])
+        covars_prior: Prior added to the variance numerator
+        block: Number of traces per block
+
+    Returns:
+        stats: Summed statistics (start, xi_sum, post, obs, obs2) and per trace scale terms
+               (A = sum gamma*y**2/var, B = sum gamma*y*mean/var with y = X/scale)
+        log_likelihood: Log likelihood of each trace, including the scale [spot]
+    """
+    N, T = X.shape
+    K = len(model['means'])
+    stats = {'start': np.zeros(K), 'xi_sum': np.zeros((K, K)), 'post': np.zeros(K),
+             'obs': np.zeros(K), 'obs2': np.zeros(K), 'A': np.zeros(N), 'B': np.zeros(N)}
+    log_likelihood = np.zeros(N)
+    for i0 in range(0, N, block):
+        i1 = min(i0+block, N)
+        Y = X[i0:i1]/scale[i0:i1,None]
+        sub = init_model(i1-i0, model['startprob'], model['transmat'], model['means'], model['covars'])
+        gamma, xi_sum, ll = e_step(Y, sub)
+        log_likelihood[i0:i1] = ll - T*np.log(scale[i0:i1])
+        stats['start'] += gamma[:,0].sum(axis=0)
+        stats['xi_sum'] += xi_sum.sum(axis=0)
+        stats['post'] += gamma.sum(axis=(0, 1))
+        stats['obs'] += np.einsum('ntk,nt->k', gamma, Y)
+        stats['obs2'] += np.einsum('ntk,nt->k', gamma, Y**2)
+        stats['A'][i0:i1] = np.einsum('ntk,nt->n', gamma/model['covars'], Y**2)
+        stats['B'][i0:i1] = np.einsum('ntk,nt->n', gamma*model['means']/model['covars'], Y)
+    return stats, log_likelihood
+
+
+def fit_pooled(X, startprob, transmat, means, covars, n_iter=100, tol=1e-4, covars_prior=1e-2, scale=False, block=512):
+    """ Baum-Welch of one model shared by all traces. With scale=True, each trace n has an
+    intensity scale s_n (x = s_n*y, y following the shared model), estimated in each
+    iteration and normalized to a geometric mean of 1.
+
+    Args:
+        X: Traces [spot, frame]
+        startprob, transmat, means, covars: Initial shared parameters
+        n_iter: Maximum number of iterations
+        tol: Convergence threshold of the gain of the total log likelihood per frame
+        covars_prior: Prior added to the variance numerator
+        scale: If True, fit a scale per trace
+        block: Number of traces per block in the E step
+
+    Returns:
+        Model dictionary with startprob, transmat, means, covars (shared), scale [spot],
+        log_likelihood [spot], n_iter and converged
+    """
+    X = np.asarray(X, dtype=float)
+    N, T = X.shape
+    model = {'startprob': np.array(startprob, dtype=float), 'transmat': np.array(transmat, dtype=float),
+             'means': np.array(means, dtype=float), 'covars': np.array(covars, dtype=float)}
+    s = np.ones(N)
+    ll_total = -np.inf
+    model['converged'] = False
+    for model['n_iter'] in range(1, n_iter+1):
+        stats, ll = pooled_statistics(X, s, model, covars_prior, block)
+
+        # M step with the statistics summed over traces
+        model['startprob'] = stats['start']/stats['start'].sum()
+        row = stats['xi_sum'].sum(axis=1, keepdims=True)
+        model['transmat'] = np.where(row > 0, stats['xi_sum']/np.where(row > 0, row, 1), model['transmat'])
+        post = stats['post']
+        if np.all(post > 0):
+            m = stats['obs']/post
+            model['covars'] = (covars_prior + stats['obs2'] - 2*m*stats['obs'] + m**2*post)/post
+            model['means'] = m
+
+        # Scale of each trace: root of A*u**2 - B*u - T = 0 with u = 1/s (relative to the current s)
+        if scale:
+            A, B = stats['A'], stats['B']
+            u = (B + np.sqrt(B**2 + 4*A*T))/(2*A)
+            s = s/u
+            g = np.exp(np.mean(np.log(s)))
+            s = s/g
+            model['means'] = model['means']*g
+            model['covars'] = model['covars']*g**2
+
+        gain = ll.sum() - ll_total
+        ll_total = ll.sum()
+        if gain < tol*N*T:
+            model['converged'] = True
+            break
+
+    model['scale'] = s
+    model['log_likelihood'] = ll
+    return model
+
+
+def fit_traces_pooled(X, startprob, transmat, means, covars, n_iter=100, tol=1e-4, scale=False):
+    """ Fit one model to all traces and decode each trace with it
+    Args:
+        X: Traces [spot, frame]
+        startprob, transmat, means, covars: Initial shared parameters
+        n_iter: Maximum number of iterations
+        tol: Convergence threshold of the gain of the total log likelihood per frame
+        scale: If True, fit an intensity scale per trace
+
+    Returns:
+        model: Shared parameters ordered by mean, with scale, log_likelihood, n_iter, converged
+        state: Viterbi path [spot, frame] (uint8)
+        rmsd: Root mean square deviation of the trace from the scaled mean of its state [spot]
+    """
+    X = np.asarray(X, dtype=float)
+    model = fit_pooled(X, startprob, transmat, means, covars, n_iter, tol, scale=scale)
+
+    # Order the states by mean
+    order = np.argsort(model['means'], kind='stable')
+    for key in ['startprob', 'means', 'covars']:
+        model[key] = model[key][order]
+    model['transmat'] = model['transmat'][order][:,order]
+
+    s = model['scale']
+    shared = init_model(len(X), model['startprob'], model['transmat'], model['means'], model['covars'])
+    state, _ = decode(X/s[:,None], shared)
+    return model, state.astype(np.uint8), state_rmsd(X, s[:,None]*model['means'], state)
+
+
+def fit_traces_warm(X, startprob, transmat, means, covars, n_iter=100, tol=1e-2, n_iter_pooled=100, scale=False, n_sample=200):
+    """ Per-trace fits started from the pooled model. The pooled fit gives every trace
+    parameters close to its own, so the per-trace EM only refines them and most traces
+    stop on tol after a few iterations. The pooled model is fitted to a random subset of
+    the traces.
+
+    Args:
+        X: Traces [spot, frame]
+        startprob, transmat, means, covars: Initial parameters of the pooled fit
+        n_iter: Maximum number of per-trace iterations. Each trace stops once its gain is
+                below tol, so the cap only bounds the slow traces.
+        tol: Convergence threshold of the log likelihood gain per trace. The pooled fit
+             uses the per-frame threshold of fit_pooled.
+        n_iter_pooled: Maximum number of iterations of the pooled fit
+        scale: If True, start each trace from the pooled model scaled to its intensity
+        n_sample: Number of traces of the pooled fit, 0 for all
+
+    Returns:
+        model, state and rmsd as in fit_traces. model['pooled'] is the pooled model.
+    """
+    X = np.asarray(X, dtype=float)
+    N, T = X.shape
+    sample = np.arange(N)
+    if n_sample and N > n_sample:
+        sample = np.sort(np.random.RandomState(0).choice(N, n_sample, replace=False))
+    pooled = fit_pooled(X[sample], startprob, transmat, means, covars, n_iter_pooled, scale=scale)
+
+    # Scale of every trace relative to the pooled model, in one step from s = 1
+    s = np.ones(N)
+    if scale:
+        stats, _ = pooled_statistics(X, s, pooled)
+        A, B = stats['A'], stats['B']
+        s = 2*A/(B + np.sqrt(B**2 + 4*A*T))
+
+    model = init_model(N, pooled['startprob'], pooled['transmat'],
+                       s[:,None]*pooled['means'], s[:,None]**2*pooled['covars'])
+    model = fit_model(X, model, n_iter, tol)
+    model['pooled'] = pooled
+    return fit_path(X, model)
+
+
+# Format version of the model files written by save_model
+model_version = 1
+
+
+def save_model(path, model, **meta):
+    """ Save shared parameters (startprob, transmat, means, covars) to an .npz file
+    Args:
+        path: File path
+        model: Parameters
+        meta: Other entries to save with them, e.g. the engine and the movie name
+    """
+    np.savez(path, version=model_version, startprob=model['startprob'], transmat=model['transmat'],
+             means=model['means'], covars=model['covars'], **meta)
+
+
+def load_model(path):
+    """ Load parameters saved by save_model
+    Args:
+        path: File path
+
+    Returns:
+        Model dictionary with startprob, transmat, means, covars and version
+    """
+    with np.load(path) as f:
+        version = int(f['version'])
+        if version > model_version:
+            raise ValueError('%s has model version %d, newer than %d' %(path, version, model_version))
+        model = {key: np.array(f[key], dtype=float) for key in ['startprob', 'transmat', 'means', 'covars']}
+    model['version'] = version
+    return model
+
+
+def decode_traces(X, model, method='viterbi', block=512):
+    """ State path of every trace with fixed shared parameters, without any fit
+    Args:
+        X: Traces [spot, frame]
+        model: Shared parameters (startprob, transmat, means, covars)
+        method: 'viterbi' (most likely path) or 'posterior' (most likely state in each frame)
+        block: Number of traces decoded at once
+
+    Returns:
+        state: [spot, frame] (uint8)
+        rmsd: Root mean square deviation of the trace from the mean of its state [spot]
+    """
+    N, T = np.shape(X)
+    state = np.zeros((N, T), dtype=np.uint8)
+    for i0 in range(0, N, block):
+        i1 = min(i0+block, N)
+        sub = init_model(i1-i0, model['startprob'], model['transmat'], model['means'], model['covars'])
+        Y = np.asarray(X[i0:i1], dtype=float)
+        if method == 'posterior':
+            gamma, _, _ = e_step(Y, sub)
+            state[i0:i1] = np.argmax(gamma, axis=2)
+        else:
+            state[i0:i1], _ = decode(Y, sub)
+    return state, state_rmsd(X, model['means'], state, block)
+
+
+def init_states(X, K, stay=0.9):
+    """ Initial parameters of K states for each trace: means at the quantiles of the trace,
+    equal variances and a transition matrix staying with probability stay
+
+    Args:
+        X: Traces [spot, frame]
+        K: Number of states
+        stay: Diagonal of the transition matrix
+
+    Returns:
+        Model dictionary [spot, ...]
+    """
+    X = np.asarray(X, dtype=float)
+    N = len(X)
+    means = np.percentile(X, 100*(np.arange(K)+0.5)/K, axis=1).T
+    var = np.var(X, axis=1)/K**2 + 1e-6
+    transmat = np.full((K, K), (1-stay)/(K-1)) if K > 1 else np.ones((1, 1))
+    if K > 1:
+        np.fill_diagonal(transmat, stay)
+    return init_model(N, np.full(K, 1/K), transmat, means, np.repeat(var[:,None], K, axis=1))
+
+
+def n_parameters(K):
+    """ Number of free parameters of a K-state Gaussian HMM
+    """
+    return (K-1) + K*(K-1) + 2*K
+
+
+def fit_k(X, K, pooled=False, n_iter=100, tol=1e-2):
+    """ Fit K states to every trace (or one K-state model to all traces) and score the fit
+    Args:
+        X: Traces [spot, frame]
+        K: Number of states
+        pooled: If True, one model shared by all traces
+        n_iter: Maximum number of iterations
+        tol: Convergence threshold of the log likelihood gain per trace (the pooled fit
+             uses the per-frame threshold of fit_pooled)
+
+    Returns:
+        model: Per-trace parameters ordered by mean
+        state: Viterbi path [spot, frame]
+        log_likelihood, bic, icl: Evidence of the model for each trace [spot]. With pooled,
+            bic and icl count the shared parameters once, spread evenly over the traces.
+    """
+    X = np.asarray(X, dtype=float)
+    N, T = X.shape
+    init = init_states(X, K)
+    if pooled:
+        start = {key: np.median(init[key], axis=0) for key in ['startprob', 'transmat', 'means', 'covars']}
+        shared = fit_pooled(X, start['startprob'], start['transmat'], np.sort(start['means']),
+                            start['covars'], n_iter)
+        model = init_model(N, shared['startprob'], shared['transmat'], shared['means'], shared['covars'])
+        penalty = n_parameters(K)*np.log(N*T)/N
+    else:
+        model = fit_model(X, init, n_iter, tol)
+        penalty = n_parameters(K)*np.log(T)
+
+    # Evidence at the final parameters
+    gamma, _, ll = e_step(X, model)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        entropy = -np.nansum(gamma*np.log(gamma), axis=(1, 2))
+    bic = -2*ll + penalty
+    icl = bic + 2*entropy
+    state, _ = decode(X, model)
+    model, state = order_states(model, state)
+    return model, state, ll, bic, icl
+
+
+def _fit_k_job(args):
+    return fit_k(*args)
+
+
+def select_states(X, k_max=3, criterion='bic', pooled=False, n_iter=100, tol=1e-2, workers=1):
+    """ Number of states of each trace by BIC or ICL, fitting K = 1..k_max
+    Args:
+        X: Traces [spot, frame]
+        k_max: Largest number of states
+        criterion: 'bic' or 'icl'
+        pooled: If True, one model per K shared by all traces and one K for all traces
+        n_iter: Maximum number of iterations
+        tol: Convergence threshold of the log likelihood gain
+        workers: Number of processes, each fitting one K
+
+    Returns:
+        Dictionary of
+            k: Chosen number of states [spot]
+            log_likelihood, bic, icl: Evidence of each K [spot, k_max]
+            means: State means of the chosen model, NaN beyond k [spot, k_max]
+            state: Viterbi path of the chosen model, states ordered by mean [spot, frame] (uint8)
+    """
+    X = np.asarray(X, dtype=float)
+    N, T = X.shape
+    jobs = [(X, K, pooled, n_iter, tol) for K in range(1, k_max+1)]
+    if workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=min(workers, k_max)) as pool:
+            fits = list(pool.map(_fit_k_job, jobs))
+    else:
+        fits = [fit_k(*job) for job in jobs]
+
+    result = {name: np.stack([f[i] for f in fits], axis=1) for i, name in [(2, 'log_likelihood'), (3, 'bic'), (4, 'icl')]}
+    score = result[criterion]
+    if pooled:
+        best = np.full(N, np.argmin(score.sum(axis=0)))
+    else:
+        best = np.argmin(score, axis=1)
+    result['k'] = best + 1
+
+    result['means'] = np.full((N, k_max), np.nan)
+    result['state'] = np.zeros((N, T), dtype=np.uint8)
+    for i, (model, state, _, _, _) in enumerate(fits):
+        sel = best == i
+        result['means'][sel,:i+1] = model['means'][sel]
+        result['state'][sel] = state[sel]
+    return result
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+apc_hmm_kernels.py
+Two-state Gaussian HMM kernels compiled with numba. Scaled forward-backward, the
+sufficient statistics of the M step and Viterbi are written out for K = 2 with the 2x2
+transitions unrolled, and the work arrays are allocated once per trace. The kernels
+give the same fits as apc_hmm.fit_traces, which is used instead when numba is not
+installed.
+
+"""
+from __future__ import division, print_function, absolute_import
+import numpy as np
+from apc_hmm import fit_traces, decode_traces, state_rmsd
+
+try:
+    from numba import njit
+    has_numba = True
+except ImportError:
+    has_numba = False
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
+
+@njit(cache=True)
+def emission_2(x, means, covars, e, c_max):
+    """ Emission probabilities of both states, divided by their max in each frame
+    """
+    k0 = -0.5*np.log(2*np.pi*covars[0])
+    k1 = -0.5*np.log(2*np.pi*covars[1])
+    for t in range(len(x)):
+        l0 = k0 - (x[t] - means[0])**2/(2*covars[0])
+        l1 = k1 - (x[t] - means[1])**2/(2*covars[1])
+        m = max(l0, l1)
+        e[t,0] = np.exp(l0 - m)
+        e[t,1] = np.exp(l1 - m)
+        c_max[t] = m
+
+
+@njit(cache=True)
+def forward_backward_2(x, startprob, transmat, means, covars, e, c_max, alpha, beta, c, stats):
+    """ Scaled forward-backward of one trace. Accumulates into stats
+    [start0, start1, xi00, xi01, xi10, xi11, post0, post1, obs0, obs1, obs2_0, obs2_1]
+    and returns the log likelihood.
+    """
+    T = len(x)
+    a00, a01, a10, a11 = transmat[0,0], transmat[0,1], transmat[1,0], transmat[1,1]
+    emission_2(x, means, covars, e, c_max)
+
+    # Forward, normalized in each frame
+    f0 = startprob[0]*e[0,0]
+    f1 = startprob[1]*e[0,1]
+    c[0] = f0 + f1
+    alpha[0,0] = f0/c[0]
+    alpha[0,1] = f1/c[0]
+    for t in range(1, T):
+        f0 = (alpha[t-1,0]*a00 + alpha[t-1,1]*a10)*e[t,0]
+        f1 = (alpha[t-1,0]*a01 + alpha[t-1,1]*a11)*e[t,1]
+        c[t] = f0 + f1
+        alpha[t,0] = f0/c[t]
+        alpha[t,1] = f1/c[t]
+
+    # Backward with the same scale
+    beta[T-1,0] = 1.
+    beta[T-1,1] = 1.
+    for t in range(T-2, -1, -1):
+        b0 = e[t+1,0]*beta[t+1,0]
+        b1 = e[t+1,1]*beta[t+1,1]
+        beta[t,0] = (a00*b0 + a01*b1)/c[t+1]
+        beta[t,1] = (a10*b0 + a11*b1)/c[t+1]
+
+    # Sufficient statistics
+    ll = 0.
+    for t in range(T):
+        ll += np.log(c[t]) + c_max[t]
+        g0 = alpha[t,0]*beta[t,0]
+        g1 = alpha[t,1]*beta[t,1]
+        s = g0 + g1
+        g0 /= s
+        g1 /= s
+        if t == 0:
+            stats[0] += g0
+            stats[1] += g1
+        else:
+            b0 = e[t,0]*beta[t,0]/c[t]
+            b1 = e[t,1]*beta[t,1]/c[t]
+            stats[2] += alpha[t-1,0]*a00*b0
+            stats[3] += alpha[t-1,0]*a01*b1
+            stats[4] += alpha[t-1,1]*a10*b0
+            stats[5] += alpha[t-1,1]*a11*b1
+        stats[6] += g0
+        stats[7] += g1
+        stats[8] += g0*x[t]
+        stats[9] += g1*x[t]
+        stats[10] += g0*x[t]**2
+        stats[11] += g1*x[t]**2
+    return ll
+
+
+@njit(cache=True)
+def m_step_2(stats, startprob, transmat, means, covars, covars_prior):
+    """ Baum-Welch update of one trace in place, as apc_hmm.m_step
+    """
+    s = stats[0] + stats[1]
+    startprob[0] = stats[0]/s
+    startprob[1] = stats[1]/s
+    for i in range(2):
+        row = stats[2+2*i] + stats[3+2*i]
+        if row > 0:
+            transmat[i,0] = stats[2+2*i]/row
+            transmat[i,1] = stats[3+2*i]/row
+    for k in range(2):
+        post = stats[6+k]
+        if post > 0:
+            m = stats[8+k]/post
+            means[k] = m
+            covars[k] = (covars_prior + stats[10+k] - 2*m*stats[8+k] + m**2*post)/post
+
+
+@njit(cache=True)
+def viterbi_2(x, startprob, transmat, means, covars, back, state):
+    """ Viterbi path of one trace in log space, written into state
+    """
+    T = len(x)
+    la00, la01 = np.log(transmat[0,0]), np.log(transmat[0,1])
+    la10, la11 = np.log(transmat[1,0]), np.log(transmat[1,1])
+    k0 = -0.5*np.log(2*np.pi*covars[0])
+    k1 = -0.5*np.log(2*np.pi*covars[1])
+    d0 = np.log(startprob[0]) + k0 - (x[0] - means[0])**2/(2*covars[0])
+    d1 = np.log(startprob[1]) + k1 - (x[0] - means[1])**2/(2*covars[1])
+    for t in range(1, T):
+        s00 = d0 + la00
+        s10 = d1 + la10
+        s01 = d0 + la01
+        s11 = d1 + la11
+        back[t,0] = 1 if s10 > s00 else 0
+        back[t,1] = 1 if s11 > s01 else 0
+        d0 = max(s00, s10) + k0 - (x[t] - means[0])**2/(2*covars[0])
+        d1 = max(s01, s11) + k1 - (x[t] - means[1])**2/(2*covars[1])
+    state[T-1] = 1 if d1 > d0 else 0
+    for t in range(T-1, 0, -1):
+        state[t-1] = back[t,state[t]]
+
+
+@njit(cache=True)
+def fit_batch_2(X, startprob, transmat, means, covars, n_iter, tol, covars_prior, state, log_likelihood, iteration, converged):
+    """ Fit and decode every trace. The parameters [spot, ...] are updated in place and
+    ordered by mean, and the outputs are written into state, log_likelihood, iteration
+    and converged.
+    """
+    N, T = X.shape
+    e = np.empty((T, 2))
+    c_max = np.empty(T)
+    alpha = np.empty((T, 2))
+    beta = np.empty((T, 2))
+    c = np.empty(T)
+    back = np.zeros((T, 2), dtype=np.int64)
+    stats = np.empty(12)
+    for n in range(N):
+        ll_old = -np.inf
+        for it in range(n_iter):
+            stats[:] = 0.
+            ll = forward_backward_2(X[n], startprob[n], transmat[n], means[n], covars[n], e, c_max, alpha, beta, c, stats)
+            m_step_2(stats, startprob[n], transmat[n], means[n], covars[n], covars_prior)
+            iteration[n] = it + 1
+            log_likelihood[n] = ll
+            if ll - ll_old < tol:
+                converged[n] = True
+                break
+            ll_old = ll
+        viterbi_2(X[n], startprob[n], transmat[n], means[n], covars[n], back, state[n])
+
+        # Order the states by mean
+        if means[n,0] > means[n,1]:
+            for t in range(T):
+                state[n,t] = 1 - state[n,t]
+            startprob[n,0], startprob[n,1] = startprob[n,1], startprob[n,0]
+            means[n,0], means[n,1] = means[n,1], means[n,0]
+            covars[n,0], covars[n,1] = covars[n,1], covars[n,0]
+            a00, a01, a10, a11 = transmat[n,0,0], transmat[n,0,1], transmat[n,1,0], transmat[n,1,1]
+            transmat[n,0,0], transmat[n,0,1], transmat[n,1,0], transmat[n,1,1] = a11, a10, a01, a00
+
+
+def fit_traces_k2(X, startprob, transmat, means, covars, n_iter=100, tol=1e-2, covars_prior=1e-2):
+    """ Two-state fit and decode of every trace with the compiled kernels, as apc_hmm.fit_traces
+    Args:
+        X: Traces [spot, frame]
+        startprob, transmat, means, covars: Initial parameters, shared or per trace
+        n_iter: Maximum number of iterations
+        tol: Convergence threshold of the log likelihood gain
+        covars_prior: Prior added to the variance numerator
+
+    Returns:
+        model, state and rmsd as in apc_hmm.fit_traces
+    """
+    if not has_numba:
+        return fit_traces(X, startprob, transmat, means, covars, n_iter, tol)
+    X = np.ascontiguousarray(X, dtype=float)
+    N, T = X.shape
+    model = {'startprob': np.array(np.broadcast_to(startprob, (N, 2)), dtype=float),
+             'transmat': np.array(np.broadcast_to(transmat, (N, 2, 2)), dtype=float),
+             'means': np.array(np.broadcast_to(means, (N, 2)), dtype=float),
+             'covars': np.array(np.broadcast_to(covars, (N, 2)), dtype=float),
+             'log_likelihood': np.zeros(N),
+             'n_iter': np.zeros(N, dtype=np.int64),
+             'converged': np.zeros(N, dtype=np.bool_)}
+    state = np.zeros((N, T), dtype=np.uint8)
+    if N > 0:
+        fit_batch_2(X, model['startprob'], model['transmat'], model['means'], model['covars'], n_iter, tol,
+                    covars_prior, state, model['log_likelihood'], model['n_iter'], model['converged'])
+    return model, state, state_rmsd(X, model['means'], state)
+
+
+@njit(cache=True)
+def viterbi_batch_2(X, startprob, transmat, means, covars, state):
+    """ Viterbi path of every trace with shared parameters, written into state
+    """
+    N, T = X.shape
+    back = np.zeros((T, 2), dtype=np.int64)
+    for n in range(N):
+        viterbi_2(X[n], startprob, transmat, means, covars, back, state[n])
+
+
+def decode_traces_k2(X, model, method='viterbi'):
+    """ Two-state decoding with fixed shared parameters, as apc_hmm.decode_traces.
+    Viterbi runs on the compiled kernel, posterior decoding on apc_hmm.
+
+    Args:
+        X: Traces [spot, frame]
+        model: Shared parameters (startprob, transmat, means, covars)
+        method: 'viterbi' or 'posterior'
+
+    Returns:
+        state and rmsd as in apc_hmm.decode_traces
+    """
+    if not has_numba or method != 'viterbi':
+        return decode_traces(X, model, method)
+    X = np.ascontiguousarray(X)
+    state = np.zeros(X.shape, dtype=np.uint8)
+    viterbi_batch_2(X, *[np.asarray(model[key], dtype=float) for key in ['startprob', 'transmat', 'means', 'covars']], state)
+    return state, state_rmsd(X, model['means'], state)
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+apc_localize.py
+Sub-pixel localization of many spots at once. The 2D Gaussian of apc_funcs.gaussian_2d
+is fitted to a stack of cut-outs with Levenberg-Marquardt iterations that are
+vectorized over the spots, using the analytic Jacobian.
+
+"""
+from __future__ import division, print_function, absolute_import
+import numpy as np
+
+
+def cut_spots(image, row, col, k):
+    """ Stack of k x k cut-outs centered at each spot
+    Args:
+        image: Image [row, col], e.g. the max projection
+        row, col: Spot positions [spot]
+        k: Cut-out size (odd)
+
+    Returns:
+        Cut-outs [spot, k, k]. Pixels outside the image repeat its border.
+    """
+    s = int((k-1)/2)
+    d = np.arange(-s, s+1)
+    r = np.clip(np.asarray(row, dtype=int)[:,None] + d, 0, image.shape[0]-1)
+    c = np.clip(np.asarray(col, dtype=int)[:,None] + d, 0, image.shape[1]-1)
+    return image[r[:,:,None], c[:,None,:]]
+
+
+def moments_batch(data):
+    """ Initial (height, x, y, width_x, width_y, offset) of every cut-out, as apc_funcs.moments
+    Args:
+        data: Cut-outs [spot, k, k]
+
+    Returns:
+        Parameters [spot, 6]
+    """
+    n, k, _ = data.shape
+    offset = data.min(axis=(1, 2))
+    w = data - offset[:,None,None] # Moments of the signal above the offset
+    total = w.sum(axis=(1, 2))
+    total[total == 0] = 1
+    X, Y = np.indices((k, k))
+    x = (X*w).sum(axis=(1, 2))/total
+    y = (Y*w).sum(axis=(1, 2))/total
+    width_x = np.sqrt(np.abs(((X - x[:,None,None])**2*w).sum(axis=(1, 2))/total))
+    width_y = np.sqrt(np.abs(((Y - y[:,None,None])**2*w).sum(axis=(1, 2))/total))
+    height = data.max(axis=(1, 2)) - offset
+    p = np.stack((height, x, y, width_x, width_y, offset), axis=1)
+    p[:,3:5] = np.clip(p[:,3:5], 0.5, k)
+    return p
+
+
+def gaussian_2d_batch(p, X, Y):
+    """ gaussian_2d evaluated for every spot
+    Args:
+        p: Parameters (height, x, y, width_x, width_y, offset) [spot, 6]
+        X, Y: Pixel coordinates [pixel]
+
+    Returns:
+        model: Model [spot, pixel]
+        J: Jacobian with respect to p [spot, pixel, 6]
+    """
+    h, x, y, wx, wy, o = [p[:,i,None] for i in range(6)]
+    u = (X - x)/wx
+    v = (Y - y)/wy
+    e = np.exp(-(u**2 + v**2)/2)
+    J = np.stack((e, h*e*u/wx, h*e*v/wy, h*e*u**2/wx, h*e*v**2/wy, np.ones_like(e)), axis=2)
+    return h*e + o, J
+
+
+def fit_gaussian_batch(data, p0=None, n_iter=50, tol=1e-6):
+    """ Least squares fit of a 2D Gaussian to every cut-out simultaneously.
+    Each spot keeps its own damping factor and stops updating once the relative
+    decrease of its residual falls below tol.
+
+    Args:
+        data: Cut-outs [spot, k, k]
+        p0: Initial parameters [spot, 6]. By default from moments_batch.
+        n_iter: Maximum number of iterations
+        tol: Relative decrease of the residual sum of squares, or relative size of the
+             step, at convergence
+
+    Returns:
+        p: (height, x, y, width_x, width_y, offset) [spot, 6], x along rows and y along columns
+        rmsd: Root mean square residual [spot]
+        converged: True if the fit converged within n_iter [spot]. Fits stopped because
+                   their damping blew up are not converged.
+    """
+    data = np.asarray(data, dtype=float)
+    n, k, _ = data.shape
+    X, Y = [a.ravel()[None,:] for a in np.indices((k, k))]
+    z = data.reshape(n, -1)
+    p = moments_batch(data) if p0 is None else np.array(p0, dtype=float)
+
+    model, J = gaussian_2d_batch(p, X, Y)
+    cost = np.sum((model - z)**2, axis=1)
+    lam = np.full(n, 1e-3)
+    converged = np.zeros(n, dtype=bool)
+    stalled = np.zeros(n, dtype=bool)
+    for _ in range(n_iter):
+        a = ~(converged | stalled)
+        if not np.any(a):
+            break
+        r = (model - z)[a]
+        JTJ = np.einsum('npi,npj->nij', J[a], J[a])
+        g = np.einsum('npi,np->ni', J[a], r)
+        A = JTJ + lam[a,None,None]*(JTJ*np.eye(6) + 1e-12*np.eye(6))
+        try:
+            step = np.linalg.solve(A, -g[:,:,None])[:,:,0]
+        except np.linalg.LinAlgError:
+            step = -np.einsum('nij,nj->ni', np.linalg.pinv(A), g)
+
+        # Accept the steps that reduce the residual, damp the others
+        p_new = p[a] + step
+        p_new[:,3:5] = np.abs(p_new[:,3:5]) + 1e-6
+        model_new, J_new = gaussian_2d_batch(p_new, X, Y)
+        cost_new = np.sum((model_new - z[a])**2, axis=1)
+        better = cost_new < cost[a]
+        index = np.flatnonzero(a)
+        small = np.sum(step**2, axis=1) <= tol**2*np.sum(p[a]**2, axis=1) # At the minimum within rounding
+        done = (better & (cost[a] - cost_new <= tol*cost[a])) | small
+        i = index[better]
+        p[i] = p_new[better]
+        model[i] = model_new[better]
+        J[i] = J_new[better]
+        cost[i] = cost_new[better]
+        lam[i] /= 10
+        lam[index[~better]] *= 10
+        converged[index[done]] = True
+        stalled[index[~done & (lam[index] > 1e10)]] = True
+
+    rmsd = (cost/(k*k))**0.5
+    return p, rmsd, converged
+
+
+def localize_spots(image, row, col, k=7, n_iter=50):
+    """ Sub-pixel position, width and amplitude of spots in an image
+    Args:
+        image: Image [row, col], e.g. the max projection
+        row, col: Integer spot positions [spot]
+        k: Cut-out size (odd)
+        n_iter: Maximum number of iterations
+
+    Returns:
+        Dictionary of arrays [spot]: row, col, width_row, width_col, height, offset, rmsd, converged
+    """
+    s = int((k-1)/2)
+    p, rmsd, converged = fit_gaussian_batch(cut_spots(image, row, col, k), n_iter=n_iter)
+    return {'row': np.asarray(row) - s + p[:,1],
+            'col': np.asarray(col) - s + p[:,2],
+            'width_row': p[:,3],
+            'width_col': p[:,4],
+            'height': p[:,0],
+            'offset': p[:,5],
+            'rmsd': rmsd,
+            'converged': converged}
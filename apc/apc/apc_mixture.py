@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+apc_mixture.py
+1D Gaussian mixture fitted to a histogram of the samples. EM runs over the bin centers
+weighted by the counts, so the cost depends on the number of bins and not on the number
+of samples, and the result is exact to within the bin resolution. two_group_stats gives
+the two intensity groups of the traces with either mixture, seeded and ordered by mean,
+so that the same traces always give the same initial HMM parameters.
+
+"""
+from __future__ import division, print_function, absolute_import
+import numpy as np
+from sklearn.mixture import GaussianMixture
+
+
+class HistogramGMM:
+    """ 1D Gaussian mixture with the fit/predict interface of sklearn's GaussianMixture.
+    The components are ordered by increasing mean.
+    """
+    def __init__(self, n_components=2, n_bin=1024, n_iter=200, tol=1e-8, n_sample=10000, random_state=0):
+        self.n_components = n_components
+        self.n_bin = n_bin
+        self.n_iter = n_iter
+        self.tol = tol
+        self.n_sample = n_sample
+        self.random_state = random_state
+
+    def _init_param(self, x):
+        """
+        1D k-means on a random subsample, started from its quantiles.
+        """
+        K = self.n_components
+        rng = np.random.RandomState(self.random_state)
+        if len(x) > self.n_sample:
+            x = x[rng.randint(len(x), size=self.n_sample)]
+        m = np.percentile(x, 100*(np.arange(K)+0.5)/K)
+        for _ in range(20):
+            label = np.argmin(np.abs(x[:,None] - m), axis=1)
+            m_new = np.array([x[label==k].mean() if any(label==k) else m[k] for k in range(K)])
+            if np.allclose(m_new, m):
+                break
+            m = m_new
+        w = np.array([np.mean(label==k) for k in range(K)]) + 1e-6
+        v = np.array([x[label==k].var() if sum(label==k) > 1 else x.var() for k in range(K)])
+        return w/w.sum(), m, np.maximum(v, 1e-6*x.var() + 1e-12)
+
+    def _log_prob(self, x):
+        """
+        log(weight_k * N(x | mean_k, var_k)) [sample, component]
+        """
+        return (np.log(self.weights_) - 0.5*np.log(2*np.pi*self.covars_)
+                - (x[:,None] - self.means_)**2/(2*self.covars_))
+
+    def fit(self, X):
+        """ Fit the mixture to the histogram of X
+        Args:
+            X: Samples, any shape (e.g. [sample, 1] as for sklearn)
+
+        Returns:
+            self
+        """
+        x = np.asarray(X, dtype=float).ravel()
+        x_min, x_max = x.min(), x.max()
+        if x_max == x_min:
+            x_max = x_min + 1.
+        self.counts, self.edges = np.histogram(x, bins=self.n_bin, range=(x_min, x_max))
+        self.centers = (self.edges[1:] + self.edges[:-1])/2
+        dx = self.edges[1] - self.edges[0]
+        c = self.counts.astype(float)
+        n = c.sum()
+        x_bin = self.centers[c > 0]
+        c = c[c > 0]
+
+        # Variance floor: regularization as in sklearn plus the bin width
+        reg = 1e-6*np.var(x_bin) + dx**2/12
+        self.weights_, self.means_, self.covars_ = self._init_param(x)
+        self.converged_ = False
+        ll_old = -np.inf
+        for self.n_iter_ in range(1, self.n_iter+1):
+            # E step
+            log_p = self._log_prob(x_bin)
+            log_norm = np.logaddexp.reduce(log_p, axis=1)
+            resp = np.exp(log_p - log_norm[:,None])*c[:,None]
+            ll = np.sum(c*log_norm)/n
+
+            # M step
+            n_k = resp.sum(axis=0) + 1e-12
+            self.weights_ = n_k/n
+            self.means_ = (resp*x_bin[:,None]).sum(axis=0)/n_k
+            self.covars_ = (resp*(x_bin[:,None] - self.means_)**2).sum(axis=0)/n_k + reg
+
+            if abs(ll - ll_old) < self.tol:
+                self.converged_ = True
+                break
+            ll_old = ll
+
+        # Order the components by mean
+        order = np.argsort(self.means_)
+        self.weights_ = self.weights_[order]
+        self.means_ = self.means_[order]
+        self.covars_ = self.covars_[order]
+        self.bin_label = self.predict(self.centers)
+        return self
+
+    def predict(self, X):
+        """ Component with the highest posterior for each sample
+        Args:
+            X: Samples, any shape
+
+        Returns:
+            Labels [sample]
+        """
+        return np.argmax(self._log_prob(np.asarray(X, dtype=float).ravel()), axis=1)
+
+    def group_stats(self):
+        """ Median, stdev and number of the samples assigned to each component,
+        computed from the histogram (median interpolated within its bin)
+
+        Returns:
+            List of (median, std, n) for each component
+        """
+        stats = []
+        dx = self.edges[1] - self.edges[0]
+        for k in range(self.n_components):
+            c = np.where(self.bin_label == k, self.counts, 0).astype(float)
+            n = c.sum()
+            if n == 0:
+                stats.append((np.nan, np.nan, 0))
+                continue
+            mean = np.sum(c*self.centers)/n
+            std = np.sqrt(np.sum(c*(self.centers - mean)**2)/n)
+            cdf = np.cumsum(c)
+            i = np.searchsorted(cdf, n/2)
+            below = cdf[i-1] if i > 0 else 0.
+            median = self.edges[i] + dx*(n/2 - below)/c[i]
+            stats.append((median, std, int(n)))
+        return stats
+
+
+def two_group_stats(X, histogram=False, random_state=0):
+    """ Median, stdev and number of the samples in each of two groups, the lower first
+    Args:
+        X: Samples, any shape
+        histogram: If True, fit HistogramGMM, otherwise sklearn's GaussianMixture
+        random_state: Seed of the mixture's initialization
+
+    Returns:
+        List of (median, std, n) for each group
+    """
+    if histogram:
+        return HistogramGMM(n_components=2, random_state=random_state).fit(X).group_stats()
+    x = np.asarray(X).reshape(-1, 1)
+    gmm = GaussianMixture(n_components=2, random_state=random_state).fit(x)
+    labels = gmm.predict(x)
+    if gmm.means_[0,0] > gmm.means_[1,0]:
+        labels = 1 - labels
+    return [(np.median(x[labels==k]), np.std(x[labels==k]), len(x[labels==k])) for k in range(2)]
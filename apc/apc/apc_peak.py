@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+apc_peak.py
+Peak detection on full fields of view. The image is split into overlapping tiles that
+are searched in parallel, and the peaks found in the overlaps are merged with a KD-tree.
+
+"""
+from __future__ import division, print_function, absolute_import
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from scipy.spatial import cKDTree
+from skimage.feature import peak_local_max
+
+
+def tile_bounds(n_row, n_col, tile, margin):
+    """ Core and padded bounds of the tiles covering an image
+    Args:
+        n_row, n_col: Image size
+        tile: Tile size (core, without the margin)
+        margin: Overlap added on each side of the core
+
+    Returns:
+        List of (core, pad) with each bound as (row0, row1, col0, col1)
+    """
+    bounds = []
+    for r0 in range(0, n_row, tile):
+        for c0 in range(0, n_col, tile):
+            core = (r0, min(r0+tile, n_row), c0, min(c0+tile, n_col))
+            pad = (max(r0-margin, 0), min(r0+tile+margin, n_row), max(c0-margin, 0), min(c0+tile+margin, n_col))
+            bounds.append((core, pad))
+    return bounds
+
+
+def find_peak_tile(image, pad, min_distance):
+    """ Local maxima of one padded tile
+    Args:
+        image: Padded tile [row, col]
+        pad: Bounds (row0, row1, col0, col1) of the tile in the full image
+        min_distance: Minimum distance between peaks
+
+    Returns:
+        Peak positions [peak, 2] in the full image
+    """
+    peak = peak_local_max(image, min_distance=min_distance, exclude_border=False)
+    return peak.reshape(-1, 2) + [pad[0], pad[2]]
+
+
+def merge_peak(image, peak, min_distance):
+    """ Keep the brightest of the peaks closer than min_distance to each other
+    Args:
+        image: Image the peaks were found in [row, col]
+        peak: Peak positions [peak, 2]
+        min_distance: Minimum distance between peaks
+
+    Returns:
+        Peak positions [peak, 2] sorted by decreasing intensity
+    """
+    peak = peak[np.argsort(-image[peak[:,0], peak[:,1]], kind='stable')]
+    keep = np.ones(len(peak), dtype=bool)
+    for i, j in sorted(cKDTree(peak).query_pairs(min_distance, p=np.inf)):
+        if keep[i]: # i is brighter than j
+            keep[j] = False
+    return peak[keep]
+
+
+def find_peak_tiled(image, min_distance, tile=256, workers=1, process=False):
+    """ Local maxima of a large image, searched tile by tile on a pool of workers.
+    Each tile is padded by 2*min_distance so that the peaks in its core see their full
+    neighborhood. Only the peaks in the core are kept, and peaks closer than min_distance
+    across tile borders are merged. As with peak_local_max, peaks within min_distance
+    of the image border are excluded.
+
+    Args:
+        image: Image [row, col], e.g. the max projection
+        min_distance: Minimum distance between peaks
+        tile: Tile size (core, without the margin)
+        workers: Number of threads (or processes)
+        process: If True, use a process pool instead of a thread pool
+
+    Returns:
+        Peak positions [peak, 2] sorted by decreasing intensity
+    """
+    n_row, n_col = image.shape
+    bounds = tile_bounds(n_row, n_col, tile, 2*min_distance)
+    images = [image[p[0]:p[1],p[2]:p[3]] for _, p in bounds]
+    pads = [p for _, p in bounds]
+
+    if workers > 1 and len(bounds) > 1:
+        Pool = ProcessPoolExecutor if process else ThreadPoolExecutor
+        with Pool(max_workers=workers) as pool:
+            peaks = list(pool.map(find_peak_tile, images, pads, [min_distance]*len(bounds)))
+    else:
+        peaks = [find_peak_tile(im, p, min_distance) for im, p in zip(images, pads)]
+
+    # Keep the peaks in the core of each tile
+    core_peak = []
+    for (core, _), peak in zip(bounds, peaks):
+        is_core = (peak[:,0] >= core[0]) & (peak[:,0] < core[1]) & (peak[:,1] >= core[2]) & (peak[:,1] < core[3])
+        core_peak.append(peak[is_core])
+    peak = np.concatenate(core_peak).astype(int)
+
+    # Exclude the image border
+    d = min_distance
+    is_inside = (peak[:,0] >= d) & (peak[:,0] < n_row-d) & (peak[:,1] >= d) & (peak[:,1] < n_col-d)
+    peak = peak[is_inside]
+    if len(peak) == 0:
+        return peak.reshape(0, 2)
+    return merge_peak(image, peak, min_distance)
+
+
+def window_projection(I, windows):
+    """ Maximum over time of the sliding-window mean, for several window sizes in one pass.
+    The window sums are updated frame by frame from the running sum, so the cost does not
+    depend on the window sizes.
+
+    Args:
+        I: Movie [frame, row, col]
+        windows: Window sizes in frames
+
+    Returns:
+        I_win: Max of the sliding mean for each window [window, row, col]
+        t_win: First frame of the window giving the max [window, row, col]
+        I_mean: Mean over the whole movie [row, col]
+    """
+    n_frame = len(I)
+    windows = [max(1, min(int(w), n_frame)) for w in windows]
+    shape = np.shape(I)[1:]
+    S = np.zeros((len(windows),) + shape)
+    I_win = np.full((len(windows),) + shape, -np.inf)
+    t_win = np.zeros((len(windows),) + shape, dtype=int)
+    I_sum = np.zeros(shape)
+    for t in range(n_frame):
+        I_t = np.asarray(I[t], dtype=float)
+        I_sum += I_t
+        for i, w in enumerate(windows):
+            S[i] += I_t
+            if t >= w:
+                S[i] -= I[t-w]
+            if t >= w-1:
+                is_max = S[i]/w > I_win[i]
+                I_win[i][is_max] = S[i][is_max]/w
+                t_win[i][is_max] = t-w+1
+    return I_win, t_win, I_sum/n_frame
+
+
+def find_peak_window(image, min_distance, n_sigma):
+    """ Local maxima of an image that stand n_sigma above its median
+    Args:
+        image: Image [row, col]
+        min_distance: Minimum distance between peaks
+        n_sigma: Threshold as a multiple of the robust stdev (MAD) of the image
+
+    Returns:
+        Peak positions [peak, 2]
+    """
+    m = np.median(image)
+    s = 1.4826*np.median(np.abs(image - m))
+    peak = peak_local_max(image, min_distance=min_distance, threshold_abs=m + n_sigma*s)
+    return peak.reshape(-1, 2)
+
+
+def first_crossing(I, peak, window, threshold):
+    """ First frame where the sliding-window mean at each peak, minus its mean over the
+    movie, rises above a threshold
+
+    Args:
+        I: Movie [frame, row, col]
+        peak: Peak positions [peak, 2]
+        window: Window size in frames, one for all peaks or one per peak [peak]
+        threshold: Threshold of the contrast, one for all peaks or one per peak [peak]
+
+    Returns:
+        First frame of the first window above the threshold, -1 for the peaks that never
+        cross it [peak]
+    """
+    peak = np.asarray(peak, dtype=int).reshape(-1, 2)
+    trace = np.asarray(I[:,peak[:,0],peak[:,1]], dtype=float)
+    n_frame, n_peak = trace.shape
+    window = np.broadcast_to(np.clip(np.asarray(window, dtype=int), 1, max(n_frame, 1)), (n_peak,))
+    threshold = np.broadcast_to(threshold, (n_peak,))
+    S = np.vstack((np.zeros((1, n_peak)), np.cumsum(trace, axis=0)))
+    first = np.full(n_peak, -1)
+    for w in np.unique(window):
+        k = window == w
+        contrast = (S[w:,k] - S[:-w,k])/w - trace[:,k].mean(axis=0)
+        above = contrast > threshold[k]
+        first[k] = np.where(above.any(axis=0), np.argmax(above, axis=0), -1)
+    return first
+
+
+def find_transient_peak(I, min_distance, windows=(5, 20, 100), n_sigma=6, workers=1):
+    """ Peaks from sliding-window mean projections, to find short binders at dim locations.
+    For each window size, the max projection of the sliding-window mean minus the mean
+    of the movie is searched for local maxima, the window images in parallel. Detections
+    closer than min_distance are merged, keeping the one with the highest contrast. The
+    first frame of a merged peak is where its sliding mean in the shortest window of its
+    detections, which has the finest time resolution, first rises above the detection
+    threshold of that window (first_crossing).
+
+    Args:
+        I: Movie [frame, row, col]
+        min_distance: Minimum distance between peaks
+        windows: Window sizes in frames
+        n_sigma: Detection threshold as a multiple of the robust stdev of each window image
+        workers: Number of threads
+
+    Returns:
+        peak: Peak positions [peak, 2] sorted by decreasing contrast
+        first_frame: First frame above the threshold, -1 if the sliding mean at the kept
+                     position never crosses it [peak]
+        window: Window size of the detection kept for each peak [peak]
+        threshold: Detection threshold of the contrast in each window [window]
+    """
+    I_win, _, I_mean = window_projection(I, windows)
+    contrast = I_win - I_mean
+
+    # Normalize each window image by its robust stdev to compare detections across windows.
+    # The threshold of find_peak_window on z is also kept in units of the contrast.
+    z = np.empty(contrast.shape)
+    threshold = np.zeros(len(windows))
+    for i, image in enumerate(contrast):
+        m = np.median(image)
+        s = 1.4826*np.median(np.abs(image - m))
+        z[i] = (image - m)/s if s > 0 else image - m
+        m_z = np.median(z[i])
+        threshold[i] = m + (m_z + n_sigma*1.4826*np.median(np.abs(z[i] - m_z)))*(s if s > 0 else 1)
+
+    detect = lambda image: find_peak_window(image, min_distance, n_sigma)
+    if workers > 1 and len(z) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            peaks = list(pool.map(detect, z))
+    else:
+        peaks = [detect(image) for image in z]
+
+    peak = np.concatenate(peaks).astype(int).reshape(-1, 2)
+    i_win = np.concatenate([np.full(len(p), i) for i, p in enumerate(peaks)]).astype(int)
+    if len(peak) == 0:
+        return peak, np.zeros(0, dtype=int), np.zeros(0, dtype=int), threshold
+    score = z[i_win, peak[:,0], peak[:,1]]
+
+    # Keep the highest contrast among close detections
+    order = np.argsort(-score, kind='stable')
+    peak, i_win = peak[order], i_win[order]
+    keep = np.ones(len(peak), dtype=bool)
+    for i, j in sorted(cKDTree(peak).query_pairs(min_distance, p=np.inf)):
+        if keep[i]:
+            keep[j] = False
+
+    # First frame from the shortest window among the detections merged into each peak
+    _, nearest = cKDTree(peak[keep]).query(peak, p=np.inf)
+    size = np.array(windows, dtype=int)[i_win]
+    i_first = np.zeros(sum(keep), dtype=int)
+    for i in np.argsort(-size, kind='stable'): # Longest window first, so the shortest is written last
+        i_first[nearest[i]] = i_win[i]
+    first_frame = first_crossing(I, peak[keep], np.array(windows, dtype=int)[i_first], threshold[i_first])
+    window = size[keep]
+    return peak[keep], first_frame, window, threshold
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+apc_pool.py
+HMM fits of the spot traces on a pool of processes. The trace matrix and the outputs
+are placed in shared memory, so each worker reads its block of traces and writes its
+results in place without pickling any array. BLAS is limited to one thread per worker,
+and every trace is fitted with a fixed random state, so the results do not depend on
+the number of workers. The traces stay in their own dtype (float32 from the movie) and
+are cast per block, and the fitted traces are not built: the state paths (uint8) and
+the intensities of the states give them.
+
+"""
+from __future__ import division, print_function, absolute_import
+import os
+import warnings
+import numpy as np
+from timeit import default_timer as timer
+from concurrent.futures import ProcessPoolExecutor
+from hmmlearn import hmm
+from apc_hmm import fit_traces
+from apc_hmm_kernels import fit_traces_k2
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+
+# Environment variables limiting the BLAS/OpenMP threads of a new process
+blas_env = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+# Outputs of fit_block: name, dtype, shape per trace (-1 for the number of frames)
+outputs = [('state', np.uint8, (-1,)),
+           ('rmsd', float, ()),
+           ('I_u', float, ()),
+           ('I_b', float, ()),
+           ('covars', float, (2,)),
+           ('transmat', float, (2, 2)),
+           ('log_likelihood', float, ()),
+           ('n_iter', int, ()),
+           ('converged', bool, ()),
+           ('fit_time', float, ())]
+
+
+def fit_trace_hmmlearn(trace, startprob, transmat, means, covars, n_iter=100, random_state=0):
+    """ Fit one trace with hmmlearn's GaussianHMM and decode it
+    Args:
+        trace: Intensity trace [frame]
+        startprob, transmat, means, covars: Initial parameters of the two states
+        n_iter: Maximum number of iterations
+        random_state: Seed of GaussianHMM's initialization
+
+    Returns:
+        Z: State path [frame], 0 = unbound, 1 = bound
+        remodel: Fitted GaussianHMM, with the states ordered as Z
+    """
+    X = trace.reshape(len(trace), 1)
+    remodel = hmm.GaussianHMM(n_components=2, covariance_type="full", n_iter=n_iter, random_state=random_state)
+    remodel.startprob_ = np.asarray(startprob, dtype=float)
+    remodel.transmat_ = np.asarray(transmat, dtype=float)
+    remodel.means_ = np.reshape(means, (2, 1))
+    remodel.covars_ = np.reshape(covars, (2, 1, 1))
+
+    # Estimate model parameters (training) and find the most likely state sequence
+    remodel.fit(X)
+    Z = remodel.predict(X)
+
+    # Reorder state number such that X[Z=0] < X[Z=1]
+    if remodel.means_[0] > remodel.means_[1]:
+        Z = 1 - Z
+        remodel.means_ = remodel.means_[::-1]
+        remodel.covars_ = remodel.covars_[::-1]
+        remodel.startprob_ = remodel.startprob_[::-1]
+        remodel.transmat_ = remodel.transmat_[::-1,::-1]
+    return Z, remodel
+
+
+def fit_block(array, i0, i1, startprob, transmat, means, covars, n_iter=100, engine='hmmlearn'):
+    """ Fit the traces i0 to i1 and write the results into the output arrays
+    Args:
+        array: Dictionary of the trace matrix ('trace') and of the outputs
+        i0, i1: Range of trace indices
+        startprob, transmat, means, covars: Initial parameters of the two states
+        n_iter: Maximum number of iterations
+        engine: 'hmmlearn' (one GaussianHMM per trace), 'batch' (apc_hmm) or 'numba' (apc_hmm_kernels)
+    """
+    trace = array['trace'][i0:i1]
+    if engine in ['batch', 'numba']:
+        fit = fit_traces_k2 if engine == 'numba' else fit_traces
+        start = timer()
+        model, state, rmsd = fit(trace, startprob, transmat, means, covars, n_iter=n_iter)
+        elapsed = timer() - start
+        array['state'][i0:i1] = state
+        array['rmsd'][i0:i1] = rmsd
+        array['I_u'][i0:i1] = model['means'][:,0]
+        array['I_b'][i0:i1] = model['means'][:,1]
+        array['covars'][i0:i1] = model['covars']
+        array['transmat'][i0:i1] = model['transmat']
+        array['log_likelihood'][i0:i1] = model['log_likelihood']
+        array['n_iter'][i0:i1] = model['n_iter']
+        array['converged'][i0:i1] = model['converged']
+
+        # The traces are fitted together, so the time of the block is shared by iterations
+        array['fit_time'][i0:i1] = elapsed*model['n_iter']/max(np.sum(model['n_iter']), 1)
+        return
+
+    for i in range(i0, i1):
+        start = timer()
+        x = np.asarray(array['trace'][i], dtype=float)
+        Z, remodel = fit_trace_hmmlearn(x, startprob, transmat, means, covars, n_iter)
+        array['fit_time'][i] = timer() - start
+        mu = remodel.means_.ravel()
+        array['state'][i] = Z
+        array['rmsd'][i] = (np.mean((mu[Z] - x)**2))**0.5
+        array['I_u'][i] = mu[0]
+        array['I_b'][i] = mu[1]
+        array['covars'][i] = remodel.covars_.ravel()
+        array['transmat'][i] = remodel.transmat_
+        array['log_likelihood'][i] = remodel.monitor_.history[-1] if remodel.monitor_.history else np.nan
+        array['n_iter'][i] = remodel.monitor_.iter
+
+        # monitor_.converged is also True at the iteration cap, so test the last gain against tol
+        history = remodel.monitor_.history
+        array['converged'][i] = len(history) > 1 and history[-1] - history[-2] < remodel.monitor_.tol
+
+
+# Shared arrays and parameters of a worker process, set by init_worker
+_worker = {}
+
+
+def init_worker(spec, param):
+    """ Attach a worker process to the shared arrays
+    Args:
+        spec: Dictionary of (shared memory name, shape, dtype) for each array
+        param: Keyword arguments of fit_block
+    """
+    from multiprocessing.shared_memory import SharedMemory
+    if threadpool_limits is not None:
+        threadpool_limits(1)
+    _worker['shm'] = [SharedMemory(name=name) for name, _, _ in spec.values()]
+    _worker['array'] = {key: np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+                        for (key, (_, shape, dtype)), shm in zip(spec.items(), _worker['shm'])}
+    _worker['param'] = param
+
+
+def fit_block_worker(bounds):
+    fit_block(_worker['array'], bounds[0], bounds[1], **_worker['param'])
+    return bounds
+
+
+def fit_traces_parallel(trace, startprob, transmat, means, covars, n_iter=100, engine='hmmlearn', workers=1, block=None):
+    """ Fit the HMM to every trace, in blocks of traces on a pool of processes
+    Args:
+        trace: Traces [spot, frame], shared in their own dtype
+        startprob, transmat, means, covars: Initial parameters of the two states
+        n_iter: Maximum number of iterations
+        engine: 'hmmlearn', 'batch' or 'numba'
+        workers: Number of processes. 1 fits in this process, as does any number on
+                 Python < 3.8, which has no shared memory.
+        block: Number of traces per task. By default 4 tasks per worker.
+
+    Returns:
+        Dictionary of state [spot, frame] (uint8) and rmsd, I_u, I_b, log_likelihood, n_iter,
+        converged, fit_time [spot], covars [spot, 2] and transmat [spot, 2, 2].
+        fit_time is in seconds, the time of a block apportioned by iterations for batch and numba.
+    """
+    trace = np.asarray(trace)
+    n_spot, n_frame = trace.shape
+    param = dict(startprob=startprob, transmat=transmat, means=means, covars=covars, n_iter=n_iter, engine=engine)
+    shapes = {name: (n_spot,) + tuple(n_frame if n < 0 else n for n in shape) for name, _, shape in outputs}
+
+    if workers > 1:
+        try:
+            from multiprocessing.shared_memory import SharedMemory
+        except ImportError:
+            warnings.warn('Shared memory needs Python 3.8 or later, fitting the traces in one process')
+            workers = 1
+
+    if workers <= 1 or n_spot < 2:
+        array = {name: np.zeros(shapes[name], dtype=dtype) for name, dtype, _ in outputs}
+        array['trace'] = trace
+        fit_block(array, 0, n_spot, **param)
+        del array['trace']
+        return array
+
+    block = block or max(1, int(np.ceil(n_spot/(4*workers))))
+    bounds = [(i, min(i+block, n_spot)) for i in range(0, n_spot, block)]
+    dtypes = dict([('trace', trace.dtype)] + [(name, dtype) for name, dtype, _ in outputs])
+    shapes['trace'] = trace.shape
+    shm = {}
+    env = {key: os.environ.get(key) for key in blas_env}
+    try:
+        array = {}
+        for name, dtype in dtypes.items():
+            nbytes = int(np.prod(shapes[name]))*np.dtype(dtype).itemsize
+            shm[name] = SharedMemory(create=True, size=max(nbytes, 1))
+            array[name] = np.ndarray(shapes[name], dtype=dtype, buffer=shm[name].buf)
+        array['trace'][:] = trace
+        spec = {name: (shm[name].name, shapes[name], dtypes[name]) for name in dtypes}
+
+        # New processes inherit the environment, which limits their BLAS threads from the start
+        os.environ.update({key: '1' for key in blas_env})
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(spec, param)) as pool:
+            list(pool.map(fit_block_worker, bounds))
+        result = {name: array[name].copy() for name, _, _ in outputs}
+    finally:
+        for key, value in env.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        array = None
+        for s in shm.values():
+            s.close()
+            s.unlink()
+    return result
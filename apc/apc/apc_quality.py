@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+apc_quality.py
+Quality features of the spot traces, computed for all traces in one vectorized pass.
+Medians use np.partition, which is linear in the number of frames.
+
+"""
+from __future__ import division, print_function, absolute_import
+import numpy as np
+
+
+def fast_median(x, axis=-1):
+    """ Median along an axis by partial sorting
+    Args:
+        x: Array
+        axis: Axis along which the median is computed
+
+    Returns:
+        Median, with the axis removed
+    """
+    x = np.moveaxis(np.asarray(x, dtype=float), axis, -1)
+    n = x.shape[-1]
+    if n == 0:
+        return np.full(x.shape[:-1], np.nan)
+    k = int(n/2)
+    if n % 2:
+        return np.partition(x, k, axis=-1)[...,k]
+    p = np.partition(x, [k-1, k], axis=-1)
+    return (p[...,k-1] + p[...,k])/2
+
+
+def is_inlier(I, m=4):
+    """ Check whether an array of data are inliers or outliers
+    Args:
+        I: Intensity signal
+        m: Threshold as multiple of the median absolute deviation
+
+    Returns:
+        True if within m*MAD from median, otherwise False
+    """
+    I = np.asarray(I, dtype=float)
+    dev = np.abs(I - fast_median(I))  # Absolute deviation from median
+    mdev = fast_median(dev)           # Median of dev
+    s = dev/mdev if mdev else 0.      # Normalized noise
+    return s < m                      # True if noise is below threshold
+
+
+# Fields of the feature table
+feature_names = ['min', 'max', 'median', 'mad', 'noise', 'snr', 'bleach_ratio', 'bleach_slope']
+
+
+def spot_features(trace, edge=0.1):
+    """ Feature table of the traces
+    Args:
+        trace: Traces [spot, frame]
+        edge: Fraction of frames at the start and end used for the bleaching ratio
+
+    Returns:
+        Structured array [spot] with the fields
+            min, max, median: Intensity statistics
+            mad: Median absolute deviation from the median
+            noise: Frame to frame noise, robust stdev of the differences divided by sqrt(2)
+            snr: (max - median)/noise
+            bleach_ratio: Mean of the last frames over the mean of the first frames
+            bleach_slope: Slope of a linear fit per frame, relative to the median
+    """
+    trace = np.asarray(trace, dtype=float)
+    n_spot, n_frame = trace.shape
+    feature = np.zeros(n_spot, dtype=[(name, float) for name in feature_names])
+    if n_spot == 0 or n_frame == 0:
+        return feature
+
+    feature['min'] = trace.min(axis=1)
+    feature['max'] = trace.max(axis=1)
+    feature['median'] = fast_median(trace, axis=1)
+    feature['mad'] = fast_median(np.abs(trace - feature['median'][:,None]), axis=1)
+
+    if n_frame > 1:
+        diff = np.diff(trace, axis=1)
+        diff_mad = fast_median(np.abs(diff - fast_median(diff, axis=1)[:,None]), axis=1)
+        feature['noise'] = 1.4826*diff_mad/2**0.5
+    with np.errstate(divide='ignore', invalid='ignore'):
+        feature['snr'] = np.where(feature['noise'] > 0, (feature['max'] - feature['median'])/feature['noise'], np.inf)
+
+        # Bleaching from the ends of the trace and from a linear fit
+        k = max(1, int(edge*n_frame))
+        first = trace[:,:k].mean(axis=1)
+        last = trace[:,-k:].mean(axis=1)
+        feature['bleach_ratio'] = np.where(first != 0, last/first, np.nan)
+        t = np.arange(n_frame) - (n_frame-1)/2
+        slope = (trace @ t)/np.sum(t**2) if n_frame > 1 else np.zeros(n_spot)
+        feature['bleach_slope'] = np.where(feature['median'] != 0, slope/feature['median'], np.nan)
+    return feature
+
+
+def spot_inlier(feature, min_cutoff, max_cutoff=None, snr_min=0, bleach_min=None):
+    """ Apply the cutoffs to the feature table
+    Args:
+        feature: Feature table from spot_features
+        min_cutoff: Outlier cutoff of the min intensity (multiple of MAD)
+        max_cutoff: Outlier cutoff of the max intensity (multiple of MAD), None to skip
+        snr_min: Minimum snr
+        bleach_min: Minimum bleach_ratio, None to skip
+
+    Returns:
+        Boolean arrays [spot]: is_min_inlier, is_max_inlier, is_inlier (all cutoffs)
+    """
+    is_min_inlier = is_inlier(feature['min'], min_cutoff)
+    is_max_inlier = is_inlier(feature['max'], max_cutoff) if max_cutoff is not None else np.ones(len(feature), dtype=bool)
+    is_good = is_min_inlier & is_max_inlier & (feature['snr'] >= snr_min)
+    if bleach_min is not None:
+        is_good &= feature['bleach_ratio'] >= bleach_min
+    return is_min_inlier, is_max_inlier, is_good
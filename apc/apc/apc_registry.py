@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+apc_registry.py
+Spot coordinates indexed by a KD-tree, for matching spots between the two channels of
+a two-color experiment or between movies of the same field. Channels are registered
+with an affine transform fitted to matched bead or bright-spot pairs, starting from the
+shift at the peak of the cross-correlation of the two spot images.
+
+"""
+from __future__ import division, print_function, absolute_import
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+def fit_affine(src, dst):
+    """ Least squares affine transform from src to dst
+    Args:
+        src, dst: Matched positions (row, col) [pair, 2]
+
+    Returns:
+        A: Affine matrix [2, 3] such that dst = A[:,:2] @ src + A[:,2]
+    """
+    src = np.asarray(src, dtype=float)
+    dst = np.asarray(dst, dtype=float)
+    if len(src) < 3:
+        # Too few pairs for an affine transform, translation only
+        A = np.zeros((2, 3))
+        A[:,:2] = np.eye(2)
+        A[:,2] = np.mean(dst - src, axis=0) if len(src) else 0.
+        return A
+    X = np.column_stack((src, np.ones(len(src))))
+    A, _, _, _ = np.linalg.lstsq(X, dst, rcond=None)
+    return A.T
+
+
+def xcorr_shift(src, dst, bin_size=2.):
+    """ Translation from src to dst at the peak of the cross-correlation of their spot
+    images, binned at bin_size and zero-padded so that the correlation does not wrap
+
+    Args:
+        src, dst: Positions (row, col) [spot, 2]
+        bin_size: Pixel size of the spot images [pixel]
+
+    Returns:
+        Shift (row, col) [2], a multiple of bin_size
+    """
+    src = np.asarray(src, dtype=float).reshape(-1, 2)
+    dst = np.asarray(dst, dtype=float).reshape(-1, 2)
+    if len(src) == 0 or len(dst) == 0:
+        return np.zeros(2)
+    lo = np.minimum(src.min(axis=0), dst.min(axis=0))
+    hi = np.maximum(src.max(axis=0), dst.max(axis=0))
+    shape = tuple(2*(np.ceil((hi - lo)/bin_size).astype(int) + 1))
+
+    def image(pos):
+        I = np.zeros(shape)
+        np.add.at(I, tuple(((pos - lo)/bin_size).astype(int).T), 1)
+        return I
+
+    c = np.fft.irfft2(np.fft.rfft2(image(dst))*np.conj(np.fft.rfft2(image(src))), s=shape)
+    peak = np.array(np.unravel_index(np.argmax(c), shape))
+    peak = np.where(peak > np.array(shape)//2, peak - np.array(shape), peak)
+    return peak*bin_size
+
+
+def apply_affine(A, pos):
+    """ Apply an affine transform to positions
+    Args:
+        A: Affine matrix [2, 3]
+        pos: Positions (row, col) [spot, 2]
+
+    Returns:
+        Transformed positions [spot, 2]
+    """
+    return np.asarray(pos, dtype=float) @ A[:,:2].T + A[:,2]
+
+
+class SpotRegistry:
+    """ Spot positions (row, col) in a KD-tree
+    """
+    def __init__(self, row, col):
+        self.pos = np.column_stack((row, col)).astype(float)
+        self.tree = cKDTree(self.pos)
+
+    @classmethod
+    def from_movie(cls, movie, spot=True):
+        """ Registry of the spots (or all peaks) of a Movie, at sub-pixel positions if available
+        """
+        if spot:
+            is_spot = movie.is_peak_inlier
+        else:
+            is_spot = np.ones(movie.n_peak, dtype=bool)
+        if hasattr(movie, 'peak_row_fit'):
+            return cls(movie.peak_row_fit[is_spot], movie.peak_col_fit[is_spot])
+        return cls(movie.peak_row[is_spot], movie.peak_col[is_spot])
+
+    def __len__(self):
+        return len(self.pos)
+
+    def query_radius(self, pos, r):
+        """ Indices of the spots within r of each position
+        Args:
+            pos: Positions (row, col) [query, 2]
+            r: Radius [pixel]
+
+        Returns:
+            List of index lists [query]
+        """
+        return self.tree.query_ball_point(np.asarray(pos, dtype=float).reshape(-1, 2), r)
+
+    def nearest(self, pos, max_distance=np.inf):
+        """ Nearest spot to each position
+        Args:
+            pos: Positions (row, col) [query, 2]
+            max_distance: Maximum distance [pixel]
+
+        Returns:
+            index: Index of the nearest spot, -1 if none within max_distance [query]
+            distance: Distance to it, inf if none [query]
+        """
+        pos = np.asarray(pos, dtype=float).reshape(-1, 2)
+        if len(self) == 0:
+            return np.full(len(pos), -1), np.full(len(pos), np.inf)
+        distance, index = self.tree.query(pos, distance_upper_bound=max_distance)
+        index[~np.isfinite(distance)] = -1
+        return index, distance
+
+    def match(self, other, max_distance, A=None):
+        """ Mutual nearest neighbours between this registry and another one
+        Args:
+            other: SpotRegistry
+            max_distance: Maximum distance of a pair [pixel]
+            A: Affine transform from this registry to the other, None for identity
+
+        Returns:
+            i, j: Indices of the matched spots in this registry and the other [pair]
+            distance: Distance of each pair after the transform [pair]
+        """
+        pos = self.pos if A is None else apply_affine(A, self.pos)
+        j, d = other.nearest(pos, max_distance)
+        i = np.flatnonzero(j >= 0)
+        j, d = j[i], d[i]
+        back, _ = SpotRegistry(*pos.T).nearest(other.pos[j], max_distance)
+        is_mutual = back == i
+        return i[is_mutual], j[is_mutual], d[is_mutual]
+
+    def register(self, other, max_distance=3., n_iter=10, A=None, n_region=4):
+        """ Affine transform from this registry to another one (e.g. channel to channel),
+        alternating mutual nearest neighbour matching and least squares fits.
+        Bright beads or spots make the best registries for this.
+
+        The fit starts from the cross-correlation shift (xcorr_shift) and from the spots
+        near the center of this registry, and takes in spots farther out in n_region
+        steps of doubling radius. A scale or a rotation displaces the far spots the most,
+        so each step starts from a transform that already holds near the center, and
+        dense spots are not paired with the wrong neighbours.
+
+        Args:
+            other: SpotRegistry
+            max_distance: Maximum distance of a pair [pixel]
+            n_iter: Maximum number of iterations in each step
+            A: Initial transform, None for the cross-correlation shift
+            n_region: Number of steps of the fitted region
+
+        Returns:
+            A: Affine matrix [2, 3]
+            rmsd: Root mean square distance of the matched pairs
+            n_pair: Number of matched pairs
+        """
+        if A is None:
+            A = np.hstack((np.eye(2), xcorr_shift(self.pos, other.pos)[:,None]))
+        r = np.linalg.norm(self.pos - np.median(self.pos, axis=0), axis=1) if len(self) else np.zeros(0)
+        for k in range(n_region, 0, -1):
+            region = SpotRegistry(*self.pos[r <= np.max(r, initial=0)/2**(k-1)].T)
+            i = np.zeros(0, dtype=int)
+            for _ in range(n_iter):
+                i_new, j, _ = region.match(other, max_distance, A)
+                if len(i_new) == 0:
+                    break
+                A = fit_affine(region.pos[i_new], other.pos[j])
+                if np.array_equal(i_new, i):
+                    break
+                i = i_new
+        _, _, d = self.match(other, max_distance, A)
+        rmsd = np.sqrt(np.mean(d**2)) if len(d) else np.nan
+        return A, rmsd, len(d)
+
+    def colocalize(self, other, max_distance=1.5, A=None):
+        """ Which spots have a partner in the other registry
+        Args:
+            other: SpotRegistry, e.g. the spots of the second channel
+            max_distance: Maximum distance to count as colocalized [pixel]
+            A: Affine transform from this registry to the other, None for identity
+
+        Returns:
+            is_coloc: True for the spots of this registry with a partner [spot]
+            partner: Index of the partner in the other registry, -1 if none [spot]
+        """
+        i, j, _ = self.match(other, max_distance, A)
+        partner = np.full(len(self), -1)
+        partner[i] = j
+        return partner >= 0, partner
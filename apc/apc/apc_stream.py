@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+apc_stream.py
+State decoding of the spot traces while the movie is being acquired. The frames arrive
+in blocks, the forward probabilities of every spot are extended frame by frame, and the
+state of each frame is decided after a fixed lag of later frames (fixed-lag smoothing).
+The model can be updated online from decaying sufficient statistics. The dwell and wait
+times are collected as the states are decided, in the classes of Movie.find_event, so
+the acquisition can be stopped once enough binding events are seen.
+
+"""
+from __future__ import division, print_function, absolute_import
+import time
+import numpy as np
+from PIL import Image
+from apc_hmm import logsumexp, _log
+from apc_trace import box_trace
+
+
+def iter_movie(path, block=50, wait=0, poll=1.):
+    """ Frames of a tif movie in blocks, read as Movie.read_movie does. With wait > 0 the
+    file is reopened every poll seconds to pick up the frames appended since, e.g. while
+    it is being written, until no frame is added for wait seconds.
+
+    Args:
+        path: Movie path
+        block: Largest number of frames per block
+        wait: Seconds to wait for new frames after the last one, 0 to read the file once
+        poll: Seconds between checks for new frames
+
+    Yields:
+        Frames [frame, row, col]
+    """
+    i0 = 0
+    idle = 0.
+    while True:
+        with Image.open(path) as movie:
+            n_frame = movie.n_frames
+            while i0 < n_frame:
+                frames = []
+                for i in range(i0, min(i0+block, n_frame)):
+                    movie.seek(i)
+                    frames.append(np.array(movie, dtype=int))
+                i0 += len(frames)
+                idle = 0.
+                yield np.array(frames)
+        if idle >= wait:
+            return
+        time.sleep(poll)
+        idle += poll
+
+
+def iter_blocks(I, block=50):
+    """ Frames of a movie array in blocks
+    Args:
+        I: Movie [frame, row, col]
+        block: Number of frames per block
+
+    Yields:
+        Frames [frame, row, col]
+    """
+    for i0 in range(0, len(I), block):
+        yield I[i0:i0+block]
+
+
+def iter_traces(blocks, row, col, spot_size):
+    """ Traces of the spots from blocks of frames
+    Args:
+        blocks: Iterable of frames [frame, row, col]
+        row, col: Spot positions [spot]
+        spot_size: Box size (odd)
+
+    Yields:
+        Traces [spot, frame]
+    """
+    for frames in blocks:
+        yield box_trace(frames, row, col, spot_size)
+
+
+class StreamDecoder:
+    """ Fixed-lag decoding of all spots with a model shared by the spots
+    (startprob, transmat, means, covars as in apc_hmm.save_model)
+    """
+    def __init__(self, model, n_spot, lag=10, online=False, decay=0.99, burn_in=20, covars_prior=1e-2):
+        """
+        Args:
+            model: Initial parameters
+            n_spot: Number of spots
+            lag: Number of later frames seen before the state of a frame is decided
+            online: If True, update the model from the decided frames (online EM)
+            decay: Decay per frame of the sufficient statistics of the online EM
+            burn_in: Number of decided frames before the first update of the model
+            covars_prior: Prior added to the variance numerator
+        """
+        self.model = {key: np.array(model[key], dtype=float) for key in ['startprob', 'transmat', 'means', 'covars']}
+        self.n_spot = n_spot
+        self.lag = lag
+        self.online = online
+        self.decay = decay
+        self.burn_in = burn_in
+        self.covars_prior = covars_prior
+        K = len(self.model['means'])
+        self.stats = {'start': np.zeros(K), 'xi_sum': np.zeros((K, K)), 'post': np.zeros(K),
+                      'obs': np.zeros(K), 'obs2': np.zeros(K)}
+        self.n_frame = 0   # Frames received
+        self.n_decided = 0 # Frames decided
+        self.log_likelihood = np.zeros(n_spot)
+        self._x = []       # Pending frames [spot] and their forward/emission log probabilities
+        self._log_alpha = []
+        self._log_B = []
+        self._log_alpha_prev = None # Forward of the last decided frame
+
+    def _log_emission(self, x):
+        m, v = self.model['means'], self.model['covars']
+        return -0.5*np.log(2*np.pi*v) - (x[:,None] - m)**2/(2*v)
+
+    def _forward(self, x):
+        log_B = self._log_emission(x)
+        last = self._log_alpha[-1] if self._log_alpha else self._log_alpha_prev
+        if last is None:
+            log_alpha = _log(self.model['startprob']) + log_B
+        else:
+            log_alpha = log_B + logsumexp(last[:,:,None] + _log(self.model['transmat']), axis=1)
+
+        # Normalized in each frame, the normalization adds up to the log likelihood
+        norm = logsumexp(log_alpha, axis=1)
+        self.log_likelihood += norm
+        self._x.append(x)
+        self._log_alpha.append(log_alpha - norm[:,None])
+        self._log_B.append(log_B)
+
+    def _decide(self, n):
+        """ Decide the first n pending frames, smoothing with all pending frames
+        """
+        log_A = _log(self.model['transmat'])
+        log_beta = np.zeros_like(self._log_alpha[-1])
+        betas = [log_beta]
+        for s in range(len(self._log_alpha)-1, 0, -1):
+            log_beta = logsumexp(log_A + (self._log_B[s] + log_beta)[:,None,:], axis=2)
+            betas.append(log_beta)
+        betas = betas[::-1]
+
+        state = np.zeros((self.n_spot, n), dtype=int)
+        for i in range(n):
+            log_gamma = self._log_alpha[i] + betas[i]
+            log_gamma -= logsumexp(log_gamma, axis=1)[:,None]
+            state[:,i] = np.argmax(log_gamma, axis=1)
+            if self.online:
+                self._accumulate(i, np.exp(log_gamma), betas[i], log_A)
+        self._log_alpha_prev = self._log_alpha[n-1]
+        del self._x[:n], self._log_alpha[:n], self._log_B[:n]
+        self.n_decided += n
+        if self.online and self.n_decided >= self.burn_in:
+            self._m_step()
+        return state
+
+    def _accumulate(self, i, gamma, log_beta, log_A):
+        """ Decay the sufficient statistics and add those of pending frame i
+        """
+        x = self._x[i]
+        for key in self.stats:
+            self.stats[key] *= self.decay
+        if self._log_alpha_prev is None and i == 0:
+            self.stats['start'] += gamma.sum(axis=0)
+        else:
+            prev = self._log_alpha[i-1] if i > 0 else self._log_alpha_prev
+            log_xi = prev[:,:,None] + log_A + (self._log_B[i] + log_beta)[:,None,:]
+            log_xi -= logsumexp(log_xi.reshape(self.n_spot, -1), axis=1)[:,None,None]
+            self.stats['xi_sum'] += np.exp(log_xi).sum(axis=0)
+        self.stats['post'] += gamma.sum(axis=0)
+        self.stats['obs'] += gamma.T @ x
+        self.stats['obs2'] += gamma.T @ x**2
+
+    def _m_step(self):
+        """ Update the model from the decayed statistics, as apc_hmm.fit_pooled
+        """
+        s = self.stats
+        if s['start'].sum() > 0:
+            self.model['startprob'] = s['start']/s['start'].sum()
+        row = s['xi_sum'].sum(axis=1, keepdims=True)
+        if np.all(row > 0):
+            self.model['transmat'] = s['xi_sum']/row
+        if np.all(s['post'] > 0):
+            m = s['obs']/s['post']
+            self.model['covars'] = (self.covars_prior + s['obs2'] - 2*m*s['obs'] + m**2*s['post'])/s['post']
+            self.model['means'] = m
+
+    def update(self, trace):
+        """ Add a block of frames
+        Args:
+            trace: Intensities of the spots [spot, frame]
+
+        Returns:
+            States of the frames decided by this block [spot, frame], lag frames behind
+        """
+        trace = np.asarray(trace, dtype=float).reshape(self.n_spot, -1)
+        decided = []
+        for x in trace.T:
+            self._forward(x)
+            self.n_frame += 1
+            if len(self._log_alpha) > self.lag:
+                decided.append(self._decide(1))
+        if not decided:
+            return np.zeros((self.n_spot, 0), dtype=int)
+        return np.concatenate(decided, axis=1)
+
+    def flush(self):
+        """ Decide all pending frames, at the end of the movie
+
+        Returns:
+            States [spot, frame]
+        """
+        if not self._log_alpha:
+            return np.zeros((self.n_spot, 0), dtype=int)
+        return self._decide(len(self._log_alpha))
+
+
+class EventTracker:
+    """ Running dwell and wait times of the decided states, in frames, in the classes of
+    Movie.find_event: 1 = pre-existing at the start, 2 = complete, 3 = incomplete at the end
+    (known at finish)
+    """
+    def __init__(self, n_spot):
+        self.n_spot = n_spot
+        self.n_frame = 0
+        self.state = np.full(n_spot, -1)         # Current state of each spot
+        self.run_start = np.zeros(n_spot, dtype=int) # Frame where the current state started
+        self.n_change = np.zeros(n_spot, dtype=int)
+        self.finished = False
+        for name in ['dwell_1', 'dwell_2', 'dwell_3', 'wait_1', 'wait_2', 'wait_3']:
+            setattr(self, name, [])
+
+    def _add(self, state, cls, length):
+        kind = 'dwell' if state == 1 else 'wait'
+        getattr(self, '%s_%d' %(kind, cls)).append(length)
+
+    def update(self, state):
+        """ Add decided states
+        Args:
+            state: States [spot, frame] following the ones already added
+        """
+        n = state.shape[1]
+        if n == 0:
+            return
+        if self.n_frame == 0:
+            self.state = state[:,0].copy()
+        prev = np.concatenate((self.state[:,None], state[:,:-1]), axis=1)
+        spot, frame = np.nonzero(state != prev)
+        for s, f in zip(spot, frame + self.n_frame):
+            self._add(self.state[s], 1 if self.n_change[s] == 0 else 2, f - self.run_start[s])
+            self.state[s] = 1 - self.state[s]
+            self.run_start[s] = f
+            self.n_change[s] += 1
+        self.n_frame += n
+
+    def finish(self):
+        """ Close the last state of the spots with events (class 3)
+        """
+        if self.finished:
+            return
+        for s in np.flatnonzero(self.n_change > 0):
+            self._add(self.state[s], 3, self.n_frame - self.run_start[s])
+        self.finished = True
+
+    @property
+    def n_dwell(self):
+        return len(self.dwell_1) + len(self.dwell_2) + len(self.dwell_3)
+
+
+def stream_events(trace_blocks, model, n_spot, lag=10, online=False, decay=0.99, min_dwell=None):
+    """ Decode blocks of traces as they arrive and collect the events
+    Args:
+        trace_blocks: Iterable of traces [spot, frame], e.g. from iter_traces
+        model: Initial parameters (startprob, transmat, means, covars)
+        n_spot: Number of spots
+        lag: Fixed lag of the decisions in frames
+        online: If True, update the model online
+        decay: Decay per frame of the online statistics
+        min_dwell: Stop after this many binding events (class 2), None to read all blocks
+
+    Returns:
+        decoder: StreamDecoder
+        tracker: EventTracker with the dwell and wait lists
+        state: Decided states [spot, frame]
+    """
+    decoder = StreamDecoder(model, n_spot, lag, online, decay)
+    tracker = EventTracker(n_spot)
+    states = []
+    for trace in trace_blocks:
+        state = decoder.update(trace)
+        tracker.update(state)
+        states.append(state)
+        if min_dwell is not None and len(tracker.dwell_2) >= min_dwell:
+            break
+    state = decoder.flush()
+    tracker.update(state)
+    tracker.finish()
+    states.append(state)
+    return decoder, tracker, np.concatenate(states, axis=1)
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+apc_trace.py
+Intensity traces of the spots in a movie. All peaks are extracted together in a
+single pass over the movie instead of slicing the movie once per peak.
+
+"""
+from __future__ import division, print_function, absolute_import
+import warnings
+import numpy as np
+from scipy.ndimage import uniform_filter
+
+
+def box_index(row, col, n, n_row, n_col):
+    """ Flat pixel index of the n x n box around each peak
+    Pixels outside the image are clipped to its border and flagged, so a box crossing
+    the border never wraps into the neighbouring row.
+
+    Args:
+        row, col: Peak positions [peak]
+        n: Box size (odd)
+        n_row, n_col: Image size
+
+    Returns:
+        index: Index table [peak, n*n] into an image raveled as [row*col]
+        inside: Whether each pixel of the box is in the image [peak, n*n]
+    """
+    s = int((n-1)/2)
+    d_row, d_col = np.mgrid[-s:s+1,-s:s+1]
+    box_row = row[:,None] + d_row.ravel()
+    box_col = col[:,None] + d_col.ravel()
+    inside = (box_row >= 0) & (box_row < n_row) & (box_col >= 0) & (box_col < n_col)
+    return np.clip(box_row, 0, n_row-1)*n_col + np.clip(box_col, 0, n_col-1), inside
+
+
+def warn_border(inside):
+    # Warn about the peaks whose box is truncated by the image border
+    n_cut = np.sum(~np.all(inside, axis=1))
+    if n_cut > 0:
+        warnings.warn('%d peaks are too close to the image border, their boxes are truncated' %(n_cut))
+
+
+def box_trace(I, row, col, spot_size, block=256):
+    """ Mean intensity in the spot_size x spot_size box around each peak in every frame.
+    The movie is read one block of frames at a time. If the boxes cover less than the
+    image, their pixels are gathered with a single fancy index from a flat index table.
+    Otherwise the block is box filtered once and sampled at the peaks. Pixels of a box
+    outside the image count as zero, as with slicing the movie at the border, and a
+    warning is issued for such peaks.
+
+    Args:
+        I: Movie [frame, row, col]
+        row, col: Peak positions [peak]
+        spot_size: Box size in pixels. As in Movie.find_peak, the box spans
+                   +/- int((spot_size-1)/2) pixels and the sum is divided by spot_size**2
+        block: Number of frames read at a time
+
+    Returns:
+        Traces [peak, frame] as float32
+    """
+    row = np.asarray(row, dtype=int)
+    col = np.asarray(col, dtype=int)
+    n_frame, n_row, n_col = np.shape(I)
+    n = 2*int((spot_size-1)/2) + 1 # Box actually summed
+    gather = len(row)*n**2 < n_row*n_col
+    index, inside = box_index(row, col, n, n_row, n_col)
+    warn_border(inside)
+    if gather:
+        index = index.ravel()
+        weight = inside.astype(np.float32)
+
+    trace = np.empty((len(row), n_frame), dtype=np.float32)
+    for i in range(0, n_frame, block):
+        I_block = np.asarray(I[i:i+block])
+        if gather:
+            I_box = I_block.reshape(len(I_block), -1)[:,index].reshape(len(I_block), len(row), n**2)
+            trace[:,i:i+block] = (I_box*weight).sum(axis=2, dtype=np.float32).T / spot_size**2
+        else:
+            I_box = uniform_filter(I_block.astype(np.float32), size=(1, n, n), mode='constant')
+            trace[:,i:i+block] = I_box[:,row,col].T * (n**2/spot_size**2)
+    return trace
+
+
+def ring_index(row, col, r_in, r_out, n_row, n_col):
+    """ Flat pixel index of the annulus r_in <= distance < r_out around each peak
+    Pixels outside the image are clipped to its border.
+
+    Args:
+        row, col: Peak positions [peak]
+        r_in, r_out: Inner and outer radius of the annulus [pixel]
+        n_row, n_col: Image size
+
+    Returns:
+        Index table [peak, n_ring] into an image raveled as [row*col]
+    """
+    m = int(np.ceil(r_out))
+    d_row, d_col = np.mgrid[-m:m+1,-m:m+1]
+    d = (d_row**2 + d_col**2)**0.5
+    is_ring = (d >= r_in) & (d < r_out)
+    ring_row = np.clip(row[:,None] + d_row[is_ring], 0, n_row-1)
+    ring_col = np.clip(col[:,None] + d_col[is_ring], 0, n_col-1)
+    return ring_row*n_col + ring_col
+
+
+def aperture_photometry(I, row, col, spot_size, r_in=None, r_out=None, background='median', block=256):
+    """ Aperture sum minus the local background from an annulus, for all peaks at once.
+    The aperture is the box of box_trace, without its pixels outside the image. The background per pixel is the median (or the
+    20% trimmed mean) of the annulus in each frame, and its spread (MAD) gives the noise.
+    Aperture and annulus pixels are gathered together with one fancy index per block.
+
+    Args:
+        I: Movie [frame, row, col]
+        row, col: Peak positions [peak]
+        spot_size: Aperture size in pixels
+        r_in, r_out: Inner and outer radius of the annulus [pixel]. By default the annulus
+                     starts one pixel outside the aperture and is two pixels wide.
+        background: 'median' or 'trim' (trimmed mean)
+        block: Number of frames read at a time
+
+    Returns:
+        signal: Background subtracted aperture sum [peak, frame]
+        bg: Background per pixel [peak, frame]
+        snr: Signal to noise ratio [peak, frame]
+    """
+    row = np.asarray(row, dtype=int)
+    col = np.asarray(col, dtype=int)
+    n_frame, n_row, n_col = np.shape(I)
+    n = 2*int((spot_size-1)/2) + 1
+    if r_in is None:
+        r_in = n/2**0.5 + 1
+    if r_out is None:
+        r_out = r_in + 2
+
+    index_ap, inside = box_index(row, col, n, n_row, n_col)
+    warn_border(inside)
+    weight = inside.astype(np.float32)
+    n_in = inside.sum(axis=1) # Aperture pixels in the image [peak]
+    index_bg = ring_index(row, col, r_in, r_out, n_row, n_col)
+    n_ap = index_ap.shape[1]
+    n_bg = index_bg.shape[1]
+    index = np.concatenate((index_ap, index_bg), axis=1).ravel()
+
+    signal = np.empty((len(row), n_frame), dtype=np.float32)
+    bg = np.empty((len(row), n_frame), dtype=np.float32)
+    noise = np.empty((len(row), n_frame), dtype=np.float32)
+    for i in range(0, n_frame, block):
+        I_block = np.asarray(I[i:i+block])
+        I_pix = I_block.reshape(len(I_block), -1)[:,index].reshape(len(I_block), len(row), n_ap+n_bg)
+        I_pix = I_pix.astype(np.float32)
+        I_ring = I_pix[:,:,n_ap:]
+        if background == 'trim':
+            k = int(0.2*n_bg)
+            I_ring = np.sort(I_ring, axis=2)
+            I_bg = I_ring[:,:,k:n_bg-k].mean(axis=2)
+        else:
+            I_bg = np.median(I_ring, axis=2)
+        s_bg = 1.4826*np.median(np.abs(I_ring - I_bg[:,:,None]), axis=2)
+        I_sig = (I_pix[:,:,:n_ap]*weight).sum(axis=2) - n_in*I_bg
+        signal[:,i:i+block] = I_sig.T
+        bg[:,i:i+block] = I_bg.T
+        noise[:,i:i+block] = ((np.maximum(I_sig, 0) + n_in*s_bg**2*(1 + n_in/n_bg))**0.5).T
+
+    snr = np.divide(signal, noise, out=np.zeros_like(signal), where=noise > 0)
+    return signal, bg, snr
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+conftest.py
+The apc modules import each other by module name, as the scripts put this directory
+on sys.path, so the tests do the same. The simulated two-state traces and the initial
+HMM parameters shared by the tests and by scripts/hmm_benchmark.py are defined here.
+
+"""
+from __future__ import division, print_function, absolute_import
+import sys
+from pathlib import Path
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+
+# Initial parameters of the fits, unbound at 100 and bound at 150
+param = dict(startprob=np.array([0.7, 0.3]),
+             transmat=np.array([[0.98, 0.02], [0.20, 0.80]]),
+             means=np.array([100., 150.]),
+             covars=np.array([64., 64.]))
+
+
+def simulate_traces(n_spot=10, n_frame=300, noise=8., I_b=(50., 50.), seed=0):
+    """Simulate two-state traces, unbound at 100 and bound at 100 + I_b.
+
+    Args:
+        n_spot: Number of traces.
+        n_frame: Number of frames of each trace.
+        noise: Standard deviation of the Gaussian noise.
+        I_b: Range of the bound intensity above the unbound one, drawn per trace.
+        seed: Seed of the random state.
+
+    Returns:
+        The traces (n_spot, n_frame) and their states.
+    """
+    rng = np.random.RandomState(seed)
+    state = np.zeros((n_spot, n_frame), dtype=int)
+    for t in range(1, n_frame):
+        p_bound = np.where(state[:,t-1] == 1, 0.9, 0.05)
+        state[:,t] = rng.rand(n_spot) < p_bound
+    I_b = rng.uniform(I_b[0], I_b[1], (n_spot, 1))
+    return 100 + state*I_b + rng.randn(n_spot, n_frame)*noise, state
+
+
+@pytest.fixture
+def simulate():
+    return simulate_traces
+
+
+@pytest.fixture
+def hmm_param():
+    return {key: value.copy() for key, value in param.items()}
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+test_apc_cache.py
+The cached fits of apc_cache reproduce the fits of the traces, survive runs on other
+subsets of the traces, all hit on an unchanged run and round-trip the state paths
+through their run-length encoding.
+
+"""
+from __future__ import division, print_function, absolute_import
+import numpy as np
+from apc_cache import FitCache, fit_traces_cached, rle_encode, rle_decode
+from apc_pool import fit_traces_parallel
+from apc_mixture import two_group_stats
+from conftest import param, simulate_traces
+
+
+def simulate():
+    return simulate_traces(n_spot=20, n_frame=150)[0]
+
+
+def fit(X):
+    return fit_traces_parallel(X, engine='batch', **param)
+
+
+def test_rle_round_trip():
+    rng = np.random.RandomState(0)
+    state = (rng.rand(7, 50) < 0.2).astype(np.uint8)
+    state[0] = 0
+    state[1] = 1
+    offset, start, length, level = rle_encode(state)
+    assert np.array_equal(rle_decode(offset, start, length, level, state.shape[1]), state)
+
+
+def test_hits_reproduce_fit(tmp_path):
+    X = simulate()
+    path = tmp_path/'fit.npz'
+    fit_traces_cached(path, X, fit, 'batch')
+    result, n_hit, n_miss = fit_traces_cached(path, X, fit, 'batch')
+    assert (n_hit, n_miss) == (len(X), 0)
+    full = fit(X)
+    for key in FitCache.fields + ['state']:
+        assert np.array_equal(result[key], full[key]), key
+
+
+def test_other_traces_kept(tmp_path):
+    X = simulate()
+    path = tmp_path/'fit.npz'
+    fit_traces_cached(path, X[:12], fit, 'batch')
+    fit_traces_cached(path, X[8:], fit, 'batch')
+    assert fit_traces_cached(path, X, fit, 'batch')[1:] == (len(X), 0)
+    fit_traces_cached(path, X[:5], fit, 'batch', max_size=8)
+    assert len(FitCache(path).keys) == 8
+
+
+def test_unchanged_run_all_hits(tmp_path):
+    # The initial parameters of the key come from the seeded two-group mixture, as in fit_spot
+    X = simulate()
+    path = tmp_path/'fit.npz'
+    for _ in range(2):
+        (m0, s0, n0), (m1, s1, n1) = two_group_stats(X)
+        key = ('batch', np.array([n0, n1])/(n0+n1), param['transmat'], np.array([m0, m1]), np.array([s0, s1]), 100)
+        result, n_hit, n_miss = fit_traces_cached(path, X, fit, *key)
+    assert m0 < m1
+    assert (n_hit, n_miss) == (len(X), 0)
+
+
+def test_no_traces(tmp_path):
+    result, n_hit, n_miss = fit_traces_cached(tmp_path/'fit.npz', np.zeros((0, 150)), fit, 'batch')
+    assert (n_hit, n_miss) == (0, 0)
+    assert result['state'].shape == (0, 150)
+    assert result['I_u'].shape == (0,)
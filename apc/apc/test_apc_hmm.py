@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+test_apc_hmm.py
+Checks of the batched HMM of apc_hmm against hmmlearn on simulated two-state traces.
+
+"""
+from __future__ import division, print_function, absolute_import
+import numpy as np
+import pytest
+from apc_hmm import fit_traces, decode_traces, init_model, e_step, fit_pooled, fit_traces_pooled, select_states, \
+    fit_traces_warm
+
+
+def test_fit_traces_hmmlearn(simulate, hmm_param):
+    hmm = pytest.importorskip('hmmlearn.hmm')
+    X, _ = simulate(n_spot=8)
+    model, state, _ = fit_traces(X, n_iter=100, **hmm_param)
+    for i, trace in enumerate(X):
+        remodel = hmm.GaussianHMM(n_components=2, covariance_type="full", n_iter=100, init_params='')
+        remodel.startprob_ = hmm_param['startprob']
+        remodel.transmat_ = hmm_param['transmat']
+        remodel.means_ = hmm_param['means'].reshape(2, 1)
+        remodel.covars_ = hmm_param['covars'].reshape(2, 1, 1)
+        remodel.fit(trace.reshape(-1, 1))
+        assert np.array_equal(state[i], remodel.predict(trace.reshape(-1, 1)))
+        assert np.allclose(model['means'][i], remodel.means_.ravel(), rtol=1e-6)
+        assert np.allclose(model['transmat'][i], remodel.transmat_, atol=1e-6)
+        assert np.isclose(model['log_likelihood'][i], remodel.monitor_.history[-1], rtol=1e-6)
+
+
+def test_fit_traces_recovers_states(simulate, hmm_param):
+    X, state_true = simulate(n_spot=8, seed=1)
+    model, state, _ = fit_traces(X, **hmm_param)
+    assert np.all(model['means'][:,0] < model['means'][:,1])
+    assert np.mean(state == state_true) > 0.98
+
+
+def test_decode_traces_posterior_and_viterbi(simulate, hmm_param):
+    X, state_true = simulate(n_spot=8, seed=2)
+    for method in ['viterbi', 'posterior']:
+        state, _ = decode_traces(X, hmm_param, method)
+        assert np.mean(state == state_true) > 0.98
+
+
+def test_e_step_normalized(simulate, hmm_param):
+    X, _ = simulate(n_spot=3, n_frame=50)
+    gamma, xi_sum, ll = e_step(X, init_model(len(X), **hmm_param))
+    assert np.allclose(gamma.sum(axis=2), 1)
+    assert np.allclose(xi_sum.sum(axis=(1, 2)), X.shape[1] - 1)
+    assert np.all(np.isfinite(ll))
+
+
+def test_fit_pooled_scale(simulate, hmm_param):
+    # Traces of one shared model, each multiplied by its own scale of geometric mean 1
+    Y, state_true = simulate(n_spot=20, seed=3)
+    s = np.exp(np.random.RandomState(1).uniform(-0.4, 0.4, len(Y)))
+    s = s/np.exp(np.mean(np.log(s)))
+    X = s[:,None]*Y
+    model = fit_pooled(X, scale=True, **hmm_param)
+    assert model['converged']
+    assert np.max(np.abs(model['scale']/s - 1)) < 0.02
+    assert np.allclose(model['means'], [100, 150], atol=2)
+    assert np.allclose(model['covars'], 64, rtol=0.1)
+    _, state, _ = fit_traces_pooled(X, scale=True, **hmm_param)
+    assert np.mean(state == state_true) > 0.99
+
+
+def simulate_3(n_spot=10, n_frame=300, seed=5):
+    # Three-state traces at 100, 150 and 200, hopping to another state with probability 0.05
+    rng = np.random.RandomState(seed)
+    state = np.zeros((n_spot, n_frame), dtype=int)
+    for t in range(1, n_frame):
+        hop = rng.rand(n_spot) < 0.05
+        state[:,t] = np.where(hop, (state[:,t-1] + rng.randint(1, 3, n_spot)) % 3, state[:,t-1])
+    return 100 + 50*state + rng.randn(n_spot, n_frame)*8, state
+
+
+@pytest.mark.parametrize('criterion', ['bic', 'icl'])
+def test_select_states(simulate, criterion):
+    X2, _ = simulate(seed=4)
+    X3, state_3 = simulate_3()
+    result = select_states(np.vstack((X2, X3)), criterion=criterion)
+    assert result['k'].tolist() == [2]*10 + [3]*10
+    assert np.mean(result['state'][10:] == state_3) > 0.99
+    assert np.all(np.isnan(result['means'][:10,2]))
+
+
+def test_select_states_pooled(simulate):
+    assert np.all(select_states(simulate(seed=4)[0], pooled=True)['k'] == 2)
+    assert np.all(select_states(simulate_3()[0], pooled=True)['k'] == 3)
+
+
+def test_fit_traces_warm_converged(simulate, hmm_param):
+    # The traces stop on tol well before the cap, and traces stopped by the cap are not converged
+    X, _ = simulate(n_spot=20, I_b=(30., 80.), seed=6)
+    model, state, _ = fit_traces_warm(X, **hmm_param)
+    assert np.all(model['converged'])
+    assert np.all(model['n_iter'] < 100)
+    assert np.array_equal(state, fit_traces(X, **hmm_param)[1])
+    capped = fit_traces_warm(X, n_iter=1, **hmm_param)[0]
+    assert not np.any(capped['converged'])
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+test_apc_hmm_kernels.py
+The compiled two-state kernels give the fits of apc_hmm.
+
+"""
+from __future__ import division, print_function, absolute_import
+import numpy as np
+import pytest
+from apc_hmm import fit_traces, decode_traces
+from apc_hmm_kernels import fit_traces_k2, decode_traces_k2, has_numba
+
+pytestmark = pytest.mark.skipif(not has_numba, reason='numba is not installed')
+
+
+def test_fit_traces_k2(simulate, hmm_param):
+    X, _ = simulate(I_b=(30., 80.))
+    ref = fit_traces(X, **hmm_param)
+    fit = fit_traces_k2(X, **hmm_param)
+    assert np.array_equal(fit[1], ref[1])
+    for key in ['startprob', 'transmat', 'means', 'covars', 'log_likelihood']:
+        assert np.allclose(fit[0][key], ref[0][key], rtol=1e-8, atol=1e-8), key
+    assert np.array_equal(fit[0]['n_iter'], ref[0]['n_iter'])
+
+
+def test_fit_traces_k2_reversed_start(simulate, hmm_param):
+    # States swapped at the start are ordered by mean in the result
+    X, _ = simulate(I_b=(30., 80.), seed=1)
+    reversed_param = dict(startprob=hmm_param['startprob'][::-1], transmat=hmm_param['transmat'][::-1,::-1],
+                          means=hmm_param['means'][::-1], covars=hmm_param['covars'])
+    ref = fit_traces(X, **reversed_param)
+    fit = fit_traces_k2(X, **reversed_param)
+    assert np.all(fit[0]['means'][:,0] < fit[0]['means'][:,1])
+    assert np.array_equal(fit[1], ref[1])
+    assert np.allclose(fit[0]['transmat'], ref[0]['transmat'])
+
+
+def test_decode_traces_k2(simulate, hmm_param):
+    X, _ = simulate(I_b=(30., 80.), seed=2)
+    assert np.array_equal(decode_traces_k2(X, hmm_param)[0], decode_traces(X, hmm_param)[0])
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+test_apc_localize.py
+The batched Gaussian fits of apc_localize recover the centres and widths of simulated
+spots, fits at the minimum are converged and fits whose damping blows up are stopped and
+reported as not converged.
+
+"""
+from __future__ import division, print_function, absolute_import
+import numpy as np
+from apc_localize import fit_gaussian_batch, gaussian_2d_batch, localize_spots
+
+
+def spots(n_spot=50, k=9, noise=1., seed=0):
+    # Cut-outs of Gaussian spots with random centres, widths and heights around the middle pixel
+    rng = np.random.RandomState(seed)
+    p = np.stack((rng.uniform(50, 100, n_spot),
+                  rng.uniform(3, 5, n_spot),
+                  rng.uniform(3, 5, n_spot),
+                  rng.uniform(1, 1.8, n_spot),
+                  rng.uniform(1, 1.8, n_spot),
+                  rng.uniform(90, 110, n_spot)), axis=1)
+    X, Y = [a.ravel()[None,:] for a in np.indices((k, k))]
+    model, _ = gaussian_2d_batch(p, X, Y)
+    return model.reshape(n_spot, k, k) + rng.randn(n_spot, k, k)*noise, p
+
+
+def test_fit_gaussian_batch():
+    data, p_true = spots()
+    p, rmsd, converged = fit_gaussian_batch(data)
+    assert np.all(converged)
+    assert np.max(np.abs(p[:,1:3] - p_true[:,1:3])) < 0.1
+    assert np.max(np.abs(p[:,3:5] - p_true[:,3:5])) < 0.1
+    assert np.max(np.abs(p[:,0] - p_true[:,0])/p_true[:,0]) < 0.1
+    assert np.all(np.abs(rmsd - 1) < 0.3)
+
+
+def test_at_minimum_converged():
+    # No step improves on the exact parameters of noiseless spots, which is convergence
+    data, p_true = spots(n_spot=5, noise=0.)
+    p, rmsd, converged = fit_gaussian_batch(data, p0=p_true)
+    assert np.all(converged)
+    assert np.array_equal(p, p_true)
+    assert np.allclose(rmsd, 0)
+
+
+def test_stalled_not_converged():
+    # No step improves on the residual of a cut-out with an invalid pixel, so its damping blows up
+    data, p_true = spots(n_spot=5)
+    data[0,2,3] = np.nan
+    p, rmsd, converged = fit_gaussian_batch(data, p0=p_true)
+    assert converged.tolist() == [False, True, True, True, True]
+    assert np.array_equal(p[0], p_true[0])
+
+
+def test_localize_spots():
+    data, p_true = spots(n_spot=3)
+    image = np.full((40, 40), 100.)
+    row, col = np.array([10, 20, 30]), np.array([30, 10, 20])
+    for i in range(3):
+        image[row[i]-4:row[i]+5, col[i]-4:col[i]+5] = data[i]
+    spot = localize_spots(image, row, col, k=9)
+    assert np.all(np.abs(spot['row'] - (row - 4 + p_true[:,1])) < 0.1)
+    assert np.all(np.abs(spot['col'] - (col - 4 + p_true[:,2])) < 0.1)
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+test_apc_peak.py
+Transient peaks of apc_peak are found with the frame where they first rise above the
+detection threshold, and peaks that never cross it are marked with -1.
+
+"""
+from __future__ import division, print_function, absolute_import
+import numpy as np
+from apc_peak import find_transient_peak, first_crossing
+
+
+def movie(n_frame=200, size=40, seed=0):
+    # Noise, a steady spot at (10, 30) and a spot at (20, 20) bound in frames 60 to 74
+    rng = np.random.RandomState(seed)
+    row, col = np.mgrid[:size,:size]
+    spot = lambda r, c: 60*np.exp(-((row - r)**2 + (col - c)**2)/2)
+    I = 100 + rng.randn(n_frame, size, size)*5 + spot(10, 30)
+    I[60:75] += spot(20, 20)
+    return I
+
+
+def test_transient_first_frame():
+    peak, first_frame, window, threshold = find_transient_peak(movie(), 3, (5, 20, 100))
+    assert peak.tolist() == [[20, 20]]
+    assert 60-5 < first_frame[0] <= 60
+    assert len(threshold) == 3
+
+
+def test_first_crossing_steady():
+    I = movie()
+    _, _, _, threshold = find_transient_peak(I, 3, (5, 20, 100))
+    first = first_crossing(I, np.array([[10, 30], [20, 20]]), 5, threshold[0])
+    assert first[0] == -1
+    assert 60-5 < first[1] <= 60
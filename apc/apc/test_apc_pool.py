@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""
+test_apc_pool.py
+The pooled fits of apc_pool do not depend on the number of workers or on the block size.
+
+"""
+from __future__ import division, print_function, absolute_import
+import numpy as np
+import pytest
+from apc_pool import fit_traces_parallel
+
+
+@pytest.mark.parametrize('engine', ['batch', 'hmmlearn'])
+def test_workers_agree(engine, simulate, hmm_param):
+    X, _ = simulate(n_spot=12, n_frame=200)
+    one = fit_traces_parallel(X, engine=engine, workers=1, **hmm_param)
+    two = fit_traces_parallel(X, engine=engine, workers=2, block=5, **hmm_param)
+    assert set(one) == set(two)
+    for key in one:
+        if key != 'fit_time':
+            assert np.array_equal(one[key], two[key]), key
+
+
+def test_states_ordered(simulate, hmm_param):
+    X = simulate(n_spot=12, n_frame=200, seed=1)[0].astype(np.float32)
+    fit = fit_traces_parallel(X, engine='batch', **hmm_param)
+    assert np.all(fit['I_u'] < fit['I_b'])
+    assert fit['state'].shape == X.shape
+    assert fit['state'].dtype == np.uint8
+    assert 'trace_fit' not in fit
+
+
+def test_cap_not_converged(simulate, hmm_param):
+    # hmmlearn's monitor reports convergence at the iteration cap too
+    X, _ = simulate(n_spot=4, n_frame=200)
+    for engine in ['batch', 'hmmlearn']:
+        fit = fit_traces_parallel(X, engine=engine, n_iter=2, **hmm_param)
+        assert not np.any(fit['converged'] & (fit['n_iter'] == 2)), engine
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+test_apc_registry.py
+SpotRegistry.register recovers the affine transform between two channels from their
+spots alone, for shifted, scaled and densely packed spots, and colocalize finds the
+spots present in both channels.
+
+"""
+from __future__ import division, print_function, absolute_import
+import numpy as np
+import pytest
+from apc_registry import SpotRegistry, apply_affine, xcorr_shift
+
+
+def channels(n_spot=2000, size=512, scale=1., angle=0., shift=(7.3, -4.1), noise=0.2, keep=0.9, seed=0):
+    # Spots of a field and of a second channel seeing a random 90% of them through an affine transform
+    rng = np.random.RandomState(seed)
+    pos = rng.rand(n_spot, 2)*size
+    c, s = np.cos(angle), np.sin(angle)
+    A = np.array([[scale*c, -scale*s, shift[0]], [scale*s, scale*c, shift[1]]])
+    other = apply_affine(A, pos) + rng.randn(n_spot, 2)*noise
+    is_kept = rng.rand(n_spot) < keep
+    return pos, other[is_kept], A
+
+
+def test_xcorr_shift():
+    pos, other, A = channels(shift=(40., -25.))
+    assert np.all(np.abs(xcorr_shift(pos, other) - A[:,2]) <= 2)
+
+
+@pytest.mark.parametrize('case', [dict(shift=(40., -25.)),
+                                  dict(scale=1.01),
+                                  dict(scale=1.02, angle=0.01),
+                                  dict(n_spot=8000, scale=1.01)])
+def test_register(case):
+    pos, other, A_true = channels(**case)
+    A, rmsd, n_pair = SpotRegistry(*pos.T).register(SpotRegistry(*other.T), max_distance=4.)
+    error = np.linalg.norm(apply_affine(A, pos) - apply_affine(A_true, pos), axis=1)
+    assert np.max(error) < 0.1
+    assert rmsd < 0.5
+    assert n_pair > 0.8*len(other)
+
+
+def test_colocalize():
+    pos, other, A = channels(n_spot=500, keep=1.)
+    other = other[::2]
+    is_coloc, partner = SpotRegistry(*pos.T).colocalize(SpotRegistry(*other.T), 1.5, A)
+    assert np.array_equal(np.flatnonzero(is_coloc), np.arange(0, 500, 2))
+    assert np.array_equal(partner[is_coloc], np.arange(250))
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+test_apc_stream.py
+The fixed-lag decisions of apc_stream agree with the decoding of the whole traces, do
+not depend on how the frames are split into blocks, and frames appended to the movie
+while it is read are picked up.
+
+"""
+from __future__ import division, print_function, absolute_import
+import numpy as np
+from PIL import Image
+from apc_hmm import decode_traces
+from apc_stream import StreamDecoder, stream_events, iter_movie, iter_blocks, iter_traces
+
+
+def blocks(X, size):
+    for i0 in range(0, X.shape[1], size):
+        yield X[:,i0:i0+size]
+
+
+def test_lag_of_whole_trace_is_posterior(simulate, hmm_param):
+    # A lag covering the whole trace smooths with every frame, as the posterior decoding
+    X, _ = simulate(n_frame=200)
+    _, _, state = stream_events(blocks(X, 30), hmm_param, len(X), lag=len(X.T))
+    assert np.array_equal(state, decode_traces(X, hmm_param, 'posterior')[0])
+
+
+def test_fixed_lag_matches_viterbi(simulate, hmm_param):
+    X, _ = simulate(n_frame=400, seed=1)
+    _, tracker, state = stream_events(blocks(X, 25), hmm_param, len(X), lag=10)
+    assert state.shape == X.shape
+    assert np.mean(state == decode_traces(X, hmm_param, 'viterbi')[0]) > 0.99
+
+    # The events of the tracker are the runs of the decided states
+    n_change = np.sum(state[:,1:] != state[:,:-1])
+    assert len(tracker.dwell_1 + tracker.dwell_2 + tracker.wait_1 + tracker.wait_2) == n_change
+
+
+def test_blocks_agree(simulate, hmm_param):
+    X, _ = simulate(n_frame=200, seed=2)
+    one = StreamDecoder(hmm_param, len(X), lag=10)
+    state = np.concatenate([one.update(X), one.flush()], axis=1)
+    for size in [1, 7, 50]:
+        assert np.array_equal(stream_events(blocks(X, size), hmm_param, len(X), lag=10)[2], state)
+
+
+def test_frames_appended_while_reading(tmp_path):
+    path = tmp_path/'movie.tif'
+    I = np.random.RandomState(0).randint(100, 200, (50, 8, 8)).astype(np.uint16)
+    write = lambda n: Image.fromarray(I[0]).save(path, save_all=True, append_images=[Image.fromarray(a) for a in I[1:n]])
+    write(30)
+    frames = iter_movie(path, block=20, wait=0.5, poll=0.1)
+    read = [next(frames), next(frames)]
+    assert sum(len(f) for f in read) == 30
+
+    # The next block is read after the movie grew
+    write(50)
+    read += list(frames)
+    assert np.array_equal(np.concatenate(read), I)
+
+
+def test_iter_traces_blocks():
+    I = np.random.RandomState(0).rand(60, 12, 12)
+    row, col = np.array([3, 8]), np.array([4, 6])
+    trace = np.concatenate(list(iter_traces(iter_blocks(I, 25), row, col, 3)), axis=1)
+    assert np.allclose(trace, [I[:,r-1:r+2,c-1:c+2].mean(axis=(1, 2)) for r, c in zip(row, col)])
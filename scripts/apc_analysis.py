@@ -20,6 +20,7 @@ import matplotlib.pyplot as plt
 from matplotlib import cm
 from pathlib import Path  
 import os
+import sys
 import shutil
 from timeit import default_timer as timer
 from scipy.ndimage import gaussian_filter
@@ -27,12 +28,25 @@ from scipy.optimize import curve_fit
 from PIL import Image
 from imreg_dft.imreg import translation
 from skimage.feature import peak_local_max
+from scipy.spatial import cKDTree
 from skimage.filters import threshold_local
 from sklearn.mixture import GaussianMixture 
-from hmmlearn import hmm
 from inspect import currentframe, getframeinfo
 fname = getframeinfo(currentframe()).filename # current file name
 current_dir = Path(fname).resolve().parent
+sys.path.append(str(current_dir.parent/'apc'/'apc'))
+from apc_drift import register_frames, keyframe_drift, track_drift, drift_quality, is_static
+from apc_trace import box_trace, aperture_photometry
+from apc_localize import localize_spots
+from apc_peak import find_peak_tiled, find_transient_peak, find_peak_window, first_crossing
+from apc_mixture import HistogramGMM, two_group_stats
+from apc_quality import is_inlier, spot_features, spot_inlier
+from apc_pool import fit_traces_parallel
+from apc_hmm import fit_traces_pooled, fit_traces_warm, save_model, load_model, select_states
+from apc_hmm_kernels import decode_traces_k2
+from apc_cache import fit_traces_cached, rle_encode
+from apc_step import fit_traces_step, step_engines
+from apc_registry import SpotRegistry
 
 # User input ----------------------------------------------------------------
 
@@ -63,21 +77,6 @@ def running_avg(x, n):
     k = np.asarray(z[:1]*m + z + z[-1:]*m, dtype=int)
     return k
 
-def is_inlier(I, m=4):
-    """ Check whether an array of data are inliers or outliers 
-    Args:
-        I: Intensity signal
-        m: Threshold as multiple of stdev 
-
-    Returns:
-        Ture if within m*stdev from median, otherwise False
-    """
-    dev = np.abs(I - np.median(I))  # Absolute deviation from median
-    mdev = np.median(dev)           # Median of dev
-    s = dev/mdev if mdev else 0.    # Normalized noise 
-    return s < m                    # True if noise is below threshold
-
-
 def gaussian(x, m, s, n):
     return n/(2*np.pi*s**2)**0.5*np.exp(-(x-m)**2/(2*s**2))
 
@@ -190,6 +189,19 @@ def get_weighted_mean(m1, s1, m2, s2, m3, s3):
 
     return weighted_mean, weighted_error
 
+
+def read_info(path):
+    # Parameters of info.txt as a dictionary of strings
+    info = {}
+    with open(path) as f:
+        for line in f:
+            line = line.replace(" ", "") # remove white space
+            if line == '\n': # skip empty line
+                continue
+            (key, value) = line.rstrip().split("=")
+            info[key] = value
+    return info
+
 class Movie:
     def __init__(self, path):
         self.path = path
@@ -202,14 +214,7 @@ class Movie:
         """
 
         # Parsing parameters from info.txt
-        self.info = {}
-        with open(Path(self.dir/'info.txt')) as f:
-            for line in f:
-                line = line.replace(" ", "") # remove white space
-                if line == '\n': # skip empty line
-                    continue
-                (key, value) = line.rstrip().split("=")
-                self.info[key] = value
+        self.info = read_info(Path(self.dir/'info.txt'))
 
         # Parameters for analysis 
         self.time_interval = float(self.info['time_interval'])
@@ -225,6 +230,46 @@ class Movie:
         self.save_trace = int(self.info['save_trace'])
         self.two_group = str2bool(self.info['two_group'])
 
+        # Optional parameters (older info.txt may not have them)
+        self.drift_keyframe = int(self.info.get('drift_keyframe', 1))
+        self.drift_keyframe_sum = str2bool(self.info.get('drift_keyframe_sum', 'False'))
+        self.drift_window = int(self.info.get('drift_window', 0))
+        self.drift_downsample = int(self.info.get('drift_downsample', 1))
+        self.drift_roi = float(self.info.get('drift_roi', 0.5))
+        self.drift_workers = int(self.info.get('drift_workers', 1))
+        self.drift_psr_min = float(self.info.get('drift_psr_min', 2.5))
+        self.drift_quality = str2bool(self.info.get('drift_quality', 'False'))
+        self.photometry = str2bool(self.info.get('photometry', 'False'))
+        self.localize = str2bool(self.info.get('localize', 'False'))
+        self.psf_width_cutoff = float(self.info.get('psf_width_cutoff', 0))
+        self.full_field = str2bool(self.info.get('full_field', 'False'))
+        self.peak_tile = int(self.info.get('peak_tile', 256))
+        self.peak_workers = int(self.info.get('peak_workers', 1))
+        self.transient_windows = [int(w) for w in self.info.get('transient_windows', '').split(',') if w]
+        self.histogram_gmm = str2bool(self.info.get('histogram_gmm', 'False'))
+        self.spot_snr_min = float(self.info.get('spot_snr_min', 0))
+        self.spot_bleach_min = float(self.info['spot_bleach_min']) if 'spot_bleach_min' in self.info else None
+        self.min_peak = int(self.info.get('min_peak', 0))
+        self.min_spot = int(self.info.get('min_spot', 0))
+        self.min_event = int(self.info.get('min_event', 0))
+        self.hmm_engine = self.info.get('hmm_engine', 'hmmlearn')
+        self.hmm_workers = int(self.info.get('hmm_workers', 1))
+        self.hmm_scale = str2bool(self.info.get('hmm_scale', 'False'))
+        self.hmm_warm_iter = int(self.info.get('hmm_warm_iter', 100))
+        self.hmm_warm_tol = float(self.info.get('hmm_warm_tol', 1e-2))
+        self.hmm_model_file = self.info.get('hmm_model', '')
+        self.hmm_decode = self.info.get('hmm_decode', 'viterbi')
+        self.hmm_cache = str2bool(self.info.get('hmm_cache', 'False'))
+        self.step_param = float(self.info['step_param']) if 'step_param' in self.info else None
+        self.hmm_k_max = int(self.info.get('hmm_k_max', 0))
+        self.hmm_k_criterion = self.info.get('hmm_k_criterion', 'bic')
+        self.hmm_k_pooled = str2bool(self.info.get('hmm_k_pooled', 'False'))
+        self.coloc_image = self.info.get('coloc_image', '')
+        self.coloc_distance = float(self.info.get('coloc_distance', 1.5))
+        self.coloc_n_sigma = float(self.info.get('coloc_n_sigma', 6))
+        self.coloc_register = str2bool(self.info.get('coloc_register', 'True'))
+        self.coloc_max_distance = float(self.info.get('coloc_max_distance', 3))
+
         # Read movie.tif using PIL.Image function
         with Image.open(self.path) as movie:
 
@@ -245,15 +290,17 @@ class Movie:
         self.n_row = int(int(n_row/self.bin_size)*self.bin_size)        
         self.n_col = int(int(n_col/self.bin_size)*self.bin_size)
         self.I_original = I[:,:self.n_row,:self.n_col]
+        self.crop_origin = (0, 0)
  
-        # Crop movie at the center if the size is larger than 300x300
-        if self.n_row > 300:
+        # Crop movie at the center if the size is larger than 300x300 (unless full_field = True)
+        if self.n_row > 300 and not self.full_field:
             print('[frame, row, col] = [%d, %d, %d]' %(self.n_frame, self.n_row, self.n_col))  
             print("Crop for row=300, col=300 \n")
             self.n_row = 300
             self.n_col = 300
             c = int(self.n_row/2)
             self.I_original = self.I_original[:,c-50:c+250,c-50:c+250]
+            self.crop_origin = (c-50, c-50)
 
         print('[frame, row, col] = [%d, %d, %d]' %(self.n_frame, self.n_row, self.n_col))  
 
@@ -347,32 +394,89 @@ class Movie:
             print('flatfield_correct = False')
 
 
-    def correct_drift(self):
+    def correct_drift(self, workers=None):
         """
-
-
-
+        Drift correction registers the frames against the mid frame and translates them back.
+        With drift_keyframe = k > 1 in info.txt, only every k-th frame (or the mean of k frames 
+        if drift_keyframe_sum = True) is registered and the drift in between is interpolated 
+        with a spline. The keyframe spacing is halved wherever the drift is faster than 1 pixel.
+        With drift_window = w > 0, each frame is instead registered by direct cross-correlation 
+        over +/- w pixels around the previous frame's drift, falling back to the full FFT 
+        registration when the correlation peak is weak. The correlation uses the central 
+        drift_roi fraction of the image, and with drift_downsample = m > 1 the search runs on 
+        m x m binned frames first.
+        The frames are registered on a thread pool of size workers (drift_workers in info.txt).
+        If a few probe frames show no drift, the field is static and the registration is skipped.
+        Each frame records whether its step was clamped by the step limit. In keyframe or window 
+        mode, or with drift_quality = True, each frame also gets the correlation peak and the 
+        peak-to-sidelobe ratio (psr) of its registration, otherwise these are NaN. Frames with 
+        psr below drift_psr_min whose translation was estimated (interpolated between keyframes 
+        or found by the windowed search) are registered again with the full FFT registration. 
+        Frames that already had the full registration (the window fallback, or the keyframes 
+        themselves without drift_keyframe_sum) are not registered twice.
         """
 
 
         self.I_drift = self.I_flatfield.copy()
         self.drift_row = np.zeros(len(self.I_drift), dtype='int')
         self.drift_col = np.zeros(len(self.I_drift), dtype='int')
+        self.drift_peak = np.full(len(self.I_drift), np.nan)
+        self.drift_psr = np.full(len(self.I_drift), np.nan)
+        self.drift_clamped = np.zeros(len(self.I_drift), dtype=bool)
+        self.drift_static = False
 
-        # Drift correct
+        # Skip drift correction if the field does not move
         if self.drift_correct:
-            print('drift_correct = True')
-
             I = self.I_flatfield.copy()
             I_ref = I[int(len(I)/2),] # Mid frame as a reference frame
+            self.drift_static = is_static(I_ref, I)
+
+        # Drift correct
+        if self.drift_correct and not self.drift_static:
+            print('drift_correct = True')
+
+            if workers is None:
+                workers = self.drift_workers
 
             # Translation as compared with I_ref
             d_row = np.zeros(len(I), dtype='int')
             d_col = np.zeros(len(I), dtype='int')
-            for i, I_frame in enumerate(I):
-                result = translation(I_ref, I_frame)
-                d_row[i] = round(result['tvec'][0])
-                d_col[i] = round(result['tvec'][1])      
+            is_registered = np.ones(len(I), dtype=bool) # Frames with the full registration of their own image
+            if self.drift_keyframe > 1:
+                k_row, k_col, self.drift_key = keyframe_drift(I, I_ref, self.drift_keyframe, self.drift_keyframe_sum, 
+                                                              workers=workers)
+                d_row[:] = np.round(k_row)
+                d_col[:] = np.round(k_col)
+                is_registered[:] = False
+                if not self.drift_keyframe_sum:
+                    is_registered[self.drift_key] = True
+                print('Registered %d keyframes' %(len(self.drift_key)))
+            elif self.drift_window > 0:
+                w_row, w_col, self.drift_fallback = track_drift(I, I_ref, self.drift_window, self.drift_roi, 
+                                                                self.drift_downsample, workers=workers)
+                d_row[:] = np.round(w_row)
+                d_col[:] = np.round(w_col)
+                is_registered[:] = self.drift_fallback
+                print('Full registration in %d frames' %(sum(self.drift_fallback)))
+            else:
+                tvec = register_frames(I_ref, I, workers)
+                d_row[:] = np.round(tvec[:,0])
+                d_col[:] = np.round(tvec[:,1])
+
+            # Quality of the registration, only where it can be acted on or is asked for
+            is_estimated = self.drift_keyframe > 1 or self.drift_window > 0
+            if is_estimated or self.drift_quality:
+                self.drift_peak, self.drift_psr = drift_quality(I_ref, I, d_row, d_col, roi=self.drift_roi, workers=workers)
+            is_poor = ~(self.drift_psr >= self.drift_psr_min) & ~is_registered
+            if is_estimated and any(is_poor):
+                # Escalate to the full registration where the quality is poor
+                tvec = register_frames(I_ref, I[is_poor], workers)
+                d_row[is_poor] = np.round(tvec[:,0])
+                d_col[is_poor] = np.round(tvec[:,1])
+                peak, psr = drift_quality(I_ref, I[is_poor], d_row[is_poor], d_col[is_poor], roi=self.drift_roi, workers=workers)
+                self.drift_peak[is_poor] = peak
+                self.drift_psr[is_poor] = psr
+                print('Full registration in %d frames with poor quality' %(sum(is_poor)))
 
             # Changes of translation between the consecutive frames
             dd_row = d_row[1:] - d_row[:-1]
@@ -380,6 +484,7 @@ class Movie:
 
             # Sudden jump in translation set to zero
             step_limit = 2
+            self.drift_clamped[1:] = (abs(dd_row)>step_limit) | (abs(dd_col)>step_limit)
             dd_row[abs(dd_row)>step_limit] = 0
             dd_col[abs(dd_col)>step_limit] = 0
 
@@ -405,6 +510,9 @@ class Movie:
             for i in range(len(I)):
                 self.I_drift[i,] = np.roll(self.I_drift[i,], self.drift_row[i], axis=0)
                 self.I_drift[i,] = np.roll(self.I_drift[i,], self.drift_col[i], axis=1)        
+            print('Clamped %d steps, %d frames with psr < %.1f' %(sum(self.drift_clamped), sum(self.drift_psr < self.drift_psr_min), self.drift_psr_min))
+        elif self.drift_static:
+            print('drift_correct = True, but the field is static. Skipped.')
         else:
             print('drift_correct = False')
       
@@ -418,48 +526,71 @@ class Movie:
         # Find local maxima from I_max
         self.I_max_smooth = gaussian_filter(self.I_max, sigma=0.1)
 
-        # Find local maxima from I_max
-        self.peak = peak_local_max(self.I_max_smooth, min_distance=int(self.spot_size*1.0))        
+        # Find local maxima from I_max. Full fields are searched in overlapping tiles in parallel.
+        if self.full_field:
+            self.peak = find_peak_tiled(self.I_max_smooth, int(self.spot_size*1.0), self.peak_tile, self.peak_workers)
+        else:
+            self.peak = peak_local_max(self.I_max_smooth, min_distance=int(self.spot_size*1.0))        
+
+        # Add short binders found in sliding-window mean projections (e.g. transient_windows = 5,20,100), 
+        # with the frame where each peak first appears (None without transient detection). A peak appears 
+        # where its mean over the shortest window first rises above the detection threshold of that window, 
+        # -1 for the peaks that never do (e.g. bound through the whole movie).
+        self.peak_first_frame = None
+        if self.transient_windows:
+            d = int(self.spot_size*1.0)
+            peak, first_frame, _, threshold = find_transient_peak(self.I, d, self.transient_windows, workers=self.peak_workers)
+            i = np.argmin(self.transient_windows)
+            self.peak_first_frame = first_crossing(self.I, self.peak, self.transient_windows[i], threshold[i])
+            if len(self.peak) and len(peak):
+                dist, _ = cKDTree(self.peak).query(peak, p=np.inf)
+                is_new = dist > d
+                peak, first_frame = peak[is_new], first_frame[is_new]
+            print('Found %d transient peaks' %(len(peak)))
+            self.peak = np.concatenate((self.peak, peak)).astype(int)
+            self.peak_first_frame = np.concatenate((self.peak_first_frame, first_frame))[::-1]
         self.n_peak = len(self.peak[:, 1])
         self.peak_row = self.peak[::-1,0]
         self.peak_col = self.peak[::-1,1]
 
-        # Get the time trace of each spots
-        self.peak_trace = np.zeros((self.n_peak, self.n_frame))
-        for i in range(self.n_peak):
-            # Get the trace from each spot
-            r = self.peak_row[i]
-            c = self.peak_col[i]
-            s = int((self.spot_size-1)/2)
-            self.peak_trace[i] = np.sum(np.sum(self.I[:,r-s:r+s+1,c-s:c+s+1], axis=2), axis=1)/self.spot_size**2
+        # Get the time trace of each spots in one pass over the movie
+        if self.photometry:
+            # Aperture sum minus the local background from an annulus, scaled as the box mean
+            print('photometry = True')
+            signal, self.peak_background, self.peak_snr = aperture_photometry(self.I, self.peak_row, self.peak_col, self.spot_size)
+            self.peak_trace = (signal/self.spot_size**2).astype(np.float32)
+        else:
+            self.peak_trace = box_trace(self.I, self.peak_row, self.peak_col, self.spot_size).astype(np.float32)
+
+        # Sub-pixel position and width of the peaks by 2D Gaussian fits to I_max
+        if self.localize or self.psf_width_cutoff > 0:
+            self.peak_fit = localize_spots(self.I_max, self.peak_row, self.peak_col, k=2*self.spot_size+1)
+            self.peak_row_fit = self.peak_fit['row']
+            self.peak_col_fit = self.peak_fit['col']
+            self.peak_width = (np.abs(self.peak_fit['width_row']*self.peak_fit['width_col']))**0.5
 
 
     # Find true spots from the peaks 
     def find_spot(self):
-        # Find inliers with I_min
-        self.peak_min = np.min(self.peak_trace, axis=1)
-        self.is_peak_min_inlier = is_inlier(self.peak_min, float(self.info['intensity_min_cutoff'])) 
+        # Features of all peak traces in one pass (min, max, median, MAD, SNR, bleaching)
+        self.peak_feature = spot_features(self.peak_trace)
+        self.peak_min = self.peak_feature['min']
+        self.peak_max = self.peak_feature['max']
 
-        # Find inliers with I_max
-        self.peak_max = np.max(self.peak_trace, axis=1)
+        # Find inliers with I_min and I_max (I_max cutoff only if two_group = False), SNR and bleaching
+        max_cutoff = None if self.two_group else float(self.info['intensity_max_cutoff'])
+        self.is_peak_min_inlier, self.is_peak_max_inlier, self.is_peak_inlier = spot_inlier(
+            self.peak_feature, float(self.info['intensity_min_cutoff']), max_cutoff, self.spot_snr_min, self.spot_bleach_min)
 
         if self.two_group == False:
             print('two_group = False')
-            self.is_peak_max_inlier = is_inlier(self.peak_max, float(self.info['intensity_max_cutoff'])) 
         else:
             print('two_group = True')
             # Train and predict data with GaussianMixture model 
             X = self.peak_max.reshape(-1,1)
-            gmm = GaussianMixture(n_components=2).fit(X)
+            GMM = HistogramGMM if self.histogram_gmm else GaussianMixture
+            gmm = GMM(n_components=2, random_state=0).fit(X)
             labels = gmm.predict(X)
-            
-            # Compare two groups
-            g0_n = len(self.peak_max[labels==0])
-            g1_n = len(self.peak_max[labels==1])
-            g0_m = np.median(self.peak_max[labels==0])
-            g1_m = np.median(self.peak_max[labels==1])        
-            g0_s = np.std(self.peak_max[labels==0])
-            g1_s = np.std(self.peak_max[labels==1])
 
             # Group in higher intensity is inliers.
             if self.peak_max[labels==0].mean() > self.peak_max[labels==1].mean():
@@ -470,13 +601,13 @@ class Movie:
             # Exclude outliers
             inliers_std = np.std(self.peak_max[self.is_peak_max_inlier])
             inliers_mean = np.mean(self.peak_max[self.is_peak_max_inlier])
-            for i, I_max in enumerate(self.peak_max):
-                if abs(I_max - inliers_mean)/inliers_std > 2:
-                    self.is_peak_max_inlier[i] = False
-
+            self.is_peak_max_inlier = self.is_peak_max_inlier & ~(np.abs(self.peak_max - inliers_mean)/inliers_std > 2)
+            self.is_peak_inlier = self.is_peak_inlier & self.is_peak_max_inlier
 
-        # Find lnliers from both I_min and I_max
-        self.is_peak_inlier = self.is_peak_min_inlier & self.is_peak_max_inlier
+        # Exclude peaks whose PSF width is off
+        if self.psf_width_cutoff > 0:
+            self.is_peak_width_inlier = is_inlier(self.peak_width, self.psf_width_cutoff) & self.peak_fit['converged']
+            self.is_peak_inlier = self.is_peak_inlier & self.is_peak_width_inlier
 
         # Find spots from the peak lnliers
         self.n_spot = sum(self.is_peak_inlier)
@@ -484,65 +615,177 @@ class Movie:
         self.spot_row = self.peak_row[self.is_peak_inlier]        
         self.spot_col = self.peak_col[self.is_peak_inlier]   
 
-        # Find two group from the entire intensity
-        X = self.trace.reshape(-1,1)
-        gmm = GaussianMixture(n_components=2).fit(X)
-        labels = gmm.predict(X)        
-
-        # Compare two groups
-        g0_n = len(X[labels==0])
-        g1_n = len(X[labels==1])
-        g0_m = np.median(X[labels==0])
-        g1_m = np.median(X[labels==1])        
-        g0_s = np.std(X[labels==0])
-        g1_s = np.std(X[labels==1])
+        # Find two group from the entire intensity, the lower first. The mixture is seeded, 
+        # so the same traces give the same initial HMM parameters (and hmm_cache keys).
+        [(g0_m, g0_s, g0_n), (g1_m, g1_s, g1_n)] = two_group_stats(self.trace, self.histogram_gmm)
         self.I_param = [g0_m, g0_s, g0_n, g1_m, g1_s, g1_n]
 
 
+    # Two-color analysis: which spots have a partner in the second channel image (coloc_image)
+    def colocalize_spot(self):
+        # Mean of the second channel image over its frames, cropped as the movie
+        with Image.open(Path(self.dir/self.coloc_image)) as image:
+            I = np.zeros((image.size[1], image.size[0]))
+            for i in range(image.n_frames):
+                image.seek(i)
+                I += np.array(image, dtype=float)
+            I /= image.n_frames
+        r0, c0 = self.crop_origin
+        I = I[r0:r0+self.n_row, c0:c0+self.n_col]
+        self.coloc_peak = find_peak_window(I, int(self.spot_size*1.0), self.coloc_n_sigma)
+        other = SpotRegistry(*self.coloc_peak.T)
+
+        # Affine transform between the channels, fitted to the peaks of this movie and the second channel
+        if self.coloc_register:
+            peaks = SpotRegistry.from_movie(self, spot=False)
+            self.coloc_affine, self.coloc_rmsd, self.coloc_n_pair = peaks.register(other, self.coloc_max_distance)
+        else:
+            self.coloc_affine, self.coloc_rmsd, self.coloc_n_pair = np.hstack((np.eye(2), np.zeros((2, 1)))), np.nan, 0
+        self.is_spot_coloc, self.spot_partner = SpotRegistry.from_movie(self).colocalize(other, self.coloc_distance, self.coloc_affine)
+        print('Colocalized spots: %d of %d (%d peaks in %s, registration rmsd = %.2f from %d pairs)' 
+              %(sum(self.is_spot_coloc), self.n_spot, len(self.coloc_peak), self.coloc_image, self.coloc_rmsd, self.coloc_n_pair))
+
+
+    # Fixed HMM parameters from a saved model file or from info.txt
+    def fixed_model(self, startprob):
+        if self.hmm_model_file:
+            model = load_model(Path(self.dir/self.hmm_model_file))
+            print('HMM model (version %d) loaded from %s' %(model['version'], self.hmm_model_file))
+            return model
+
+        values = lambda key: np.array([float(v) for v in self.info[key].split(',')])
+        model = {'startprob': values('hmm_startprob') if 'hmm_startprob' in self.info else startprob, 
+                 'transmat': values('hmm_transmat').reshape(2, 2), 
+                 'means': values('hmm_means'), 
+                 'covars': values('hmm_covars')}
+        return model
+
+
     # Fit traces
-    def fit_spot(self):
-        self.trace_fit = np.zeros((self.n_spot, self.n_frame))
-        self.state = np.zeros((self.n_spot, self.n_frame))        
-        self.rmsd = np.zeros(self.n_spot)
-        self.I_u = np.zeros(self.n_spot)
-        self.I_b = np.zeros(self.n_spot)
-
-        # Fit the time trace using HMM    
-        for i, trace in enumerate(self.trace):
-            X = trace.reshape(len(trace), 1) 
-          
-            # Set a new model for traidning
-            param=set(X.ravel())
-            remodel = hmm.GaussianHMM(n_components=2, covariance_type="full", n_iter=100)        
-        
-            # Set initial parameters for training
-            remodel.startprob_ = np.array([self.I_param[2]/(self.I_param[2]+self.I_param[5]), 
-                                           self.I_param[5]/(self.I_param[2]+self.I_param[5])])
-            remodel.transmat_ = np.array([[0.98, 0.02], 
-                                          [0.20, 0.80]])
-            remodel.means_ = np.array([self.I_param[0], self.I_param[3]])  
-            remodel.covars_ = np.array([[[self.I_param[1]]],
-                                        [[self.I_param[4]]]])
-           
-            # Estimate model parameters (training)
-            remodel.fit(X)
-
-            # Find most likely state sequence corresponding to X
-            Z = remodel.predict(X)
-
-            # Reorder state number such that X[Z=0] < X[Z=1] 
-            if remodel.means_[0] > remodel.means_[1]:
-                Z = 1 - Z
-                remodel.means_ = remodel.means_[::-1]
-
-            # Intensity trace fit     
-            self.state[i] = np.array(Z) 
-            self.trace_fit[i] = (1-Z)*remodel.means_[0] + Z*remodel.means_[1]     
-            self.rmsd[i] = (np.mean((self.trace_fit[i] - trace)**2))**0.5           
-
-            # Mean intensity of the two states
-            self.I_u[i] = remodel.means_[0]
-            self.I_b[i] = remodel.means_[1]
+    def fit_spot(self, workers=None):
+        if workers is None:
+            workers = self.hmm_workers
+
+        # Initial parameters of the HMM from the intensity distribution of the spots
+        startprob = np.array([self.I_param[2]/(self.I_param[2]+self.I_param[5]), 
+                              self.I_param[5]/(self.I_param[2]+self.I_param[5])])
+        transmat = np.array([[0.98, 0.02], 
+                             [0.20, 0.80]])
+        means = np.array([self.I_param[0], self.I_param[3]])  
+        covars = np.array([self.I_param[1], self.I_param[4]])
+        start = timer()
+
+        # Fit one HMM shared by all the traces and decode each trace with it
+        if self.hmm_engine == 'pooled':
+            model, state, rmsd = fit_traces_pooled(self.trace, startprob, transmat, means, covars, 
+                                                   n_iter=100, scale=self.hmm_scale)
+            self.hmm_model = model
+            self.hmm_transmat = model['transmat']
+            fit = {'state': state, 'rmsd': rmsd, 
+                   'I_u': model['scale']*model['means'][0], 
+                   'I_b': model['scale']*model['means'][1], 
+                   'log_likelihood': model['log_likelihood'], 
+                   'n_iter': np.full(self.n_spot, model['n_iter']), 
+                   'converged': np.full(self.n_spot, model['converged'])}
+
+        # Fit each trace starting from the pooled model, until its gain is below hmm_warm_tol
+        elif self.hmm_engine == 'warm':
+            model, state, rmsd = fit_traces_warm(self.trace, startprob, transmat, means, covars, 
+                                                 n_iter=self.hmm_warm_iter, tol=self.hmm_warm_tol, 
+                                                 scale=self.hmm_scale)
+            self.hmm_model = model['pooled']
+            self.hmm_transmat = model['pooled']['transmat']
+            fit = {'state': state, 'rmsd': rmsd, 
+                   'I_u': model['means'][:,0], 
+                   'I_b': model['means'][:,1], 
+                   'log_likelihood': model['log_likelihood'], 
+                   'n_iter': model['n_iter'], 
+                   'converged': model['converged']}
+            print('Per-trace HMM: %.1f iterations on average, %d of %d traces not converged within %d iterations' 
+                  %(np.mean(model['n_iter']), sum(~model['converged']), self.n_spot, self.hmm_warm_iter))
+
+        # Decode the traces with fixed parameters, without fitting
+        elif self.hmm_engine == 'fixed':
+            self.hmm_model = self.fixed_model(startprob)
+            self.hmm_transmat = self.hmm_model['transmat']
+            state, rmsd = decode_traces_k2(self.trace, self.hmm_model, self.hmm_decode)
+
+            # The state intensities are the model means, as in rmsd
+            fit = {'state': state, 'rmsd': rmsd, 
+                   'I_u': np.full(self.n_spot, self.hmm_model['means'][0], dtype=float), 
+                   'I_b': np.full(self.n_spot, self.hmm_model['means'][1], dtype=float), 
+                   'log_likelihood': np.full(self.n_spot, np.nan), 
+                   'n_iter': np.full(self.n_spot, -1), 
+                   'converged': np.zeros(self.n_spot, dtype=bool)}
+
+        # Fit the time traces using HMM, or detect their steps with a pwctools engine (apc_step), 
+        # in parallel if workers > 1
+        else:
+            # hmmlearn initializes the parameters itself (its init_params), so they are not part of its key
+            if self.hmm_engine == 'hmmlearn':
+                key = (self.hmm_engine, 100)
+            else:
+                key = (self.hmm_engine, startprob, transmat, means, covars, 100)
+            if self.hmm_engine in step_engines:
+                fit_trace = lambda trace: fit_traces_step(trace, self.hmm_engine, self.step_param, workers)
+                key += (self.step_param,)
+            else:
+                fit_trace = lambda trace: fit_traces_parallel(trace, startprob, transmat, means, covars, n_iter=100, 
+                                                              engine=self.hmm_engine, workers=workers)
+
+            # Fit only the traces without results in the cache (hmm_cache.npz)
+            if self.hmm_cache:
+                fit, self.hmm_cache_hits, self.hmm_cache_misses = fit_traces_cached(Path(self.dir/'hmm_cache.npz'), self.trace, fit_trace, *key)
+                print('HMM cache: %d hits, %d misses' %(self.hmm_cache_hits, self.hmm_cache_misses))
+            else:
+                fit = fit_trace(self.trace)
+        elapsed = timer() - start
+
+        # State paths (uint8) and the intensity of each state, from which trace_fit is rebuilt. 
+        # No engine builds the fitted traces [spot, frame] themselves.
+        self.state = fit['state'].astype(np.uint8, copy=False)
+        self.level = np.column_stack((fit['I_u'], fit['I_b']))
+        self.rmsd = fit['rmsd']
+        self.I_u = fit['I_u']
+        self.I_b = fit['I_b']
+        self.hmm_log_likelihood = fit['log_likelihood']
+        self.hmm_n_iter = fit['n_iter']
+        self.hmm_converged = fit['converged']
+
+        # Per-trace fit record. Engines fitting all traces at once share their time by iterations 
+        # (an estimate, as only hmmlearn and the step engines time each trace), and traces found in 
+        # the cache take no time.
+        self.fit_time_measured = self.hmm_engine == 'hmmlearn' or self.hmm_engine in step_engines
+        if 'fit_time' in fit:
+            fit_time = fit['fit_time']
+        elif self.hmm_cache and self.hmm_engine not in ['pooled', 'warm', 'fixed']:
+            fit_time = np.zeros(self.n_spot)
+        elif np.sum(self.hmm_n_iter) > 0:
+            fit_time = elapsed*self.hmm_n_iter/np.sum(self.hmm_n_iter)
+        else:
+            fit_time = np.full(self.n_spot, elapsed/max(self.n_spot, 1))
+        # Engines without iterations (fixed and the step engines) have n_iter = -1 and converged = -1, 
+        # not applicable
+        self.fit_stat = np.zeros(self.n_spot, dtype=[('spot', int), ('engine', 'U16'), ('n_iter', int), ('fit_time', float), 
+                                                     ('log_likelihood', float), ('converged', np.int8), ('snr', float), ('rmsd', float)])
+        self.fit_stat['spot'] = np.arange(self.n_spot)
+        self.fit_stat['engine'] = self.hmm_engine
+        self.fit_stat['n_iter'] = self.hmm_n_iter
+        self.fit_stat['fit_time'] = fit_time
+        self.fit_stat['log_likelihood'] = self.hmm_log_likelihood
+        self.fit_stat['converged'] = np.where(self.hmm_n_iter < 0, -1, self.hmm_converged)
+        self.fit_stat['snr'] = (self.I_b - self.I_u)/np.maximum(self.rmsd, 1e-12)
+        self.fit_stat['rmsd'] = self.rmsd
+        for line in self.fit_summary():
+            print(line)
+
+        # Number of states of each trace (K = 1..hmm_k_max) by BIC or ICL, kept apart from the
+        # two-state analysis so the multi-occupancy spots can be analyzed from hmm_states.npz
+        if self.hmm_k_max > 0:
+            self.hmm_states = select_states(self.trace, self.hmm_k_max, self.hmm_k_criterion, 
+                                            pooled=self.hmm_k_pooled, workers=workers)
+            print('Number of HMM states (%s):' %(self.hmm_k_criterion), 
+                  np.bincount(self.hmm_states['k'], minlength=self.hmm_k_max+1)[1:])
 
         # Find inliners and exclude outliers
         self.is_rmsd_inlier = is_inlier(self.rmsd, float(self.info['HMM_RMSD_cutoff']))
@@ -561,6 +804,35 @@ class Movie:
         print('Rejected', self.n_peak - len(self.rmsd_inlier), 'outliers.')   
 
 
+    @property
+    def trace_fit(self):
+        # Intensity trace fit [spot, frame], rebuilt from the state paths on access
+        return np.take_along_axis(self.level, self.state.astype(np.intp), axis=1).astype(np.float32)
+
+
+    def fit_summary(self, n_slow=5):
+        # Distribution of the fit times and the slowest traces, as lines of text
+        s = self.fit_stat
+        if len(s) == 0:
+            return ['Fit (%s): no traces' %(self.hmm_engine)]
+        t = s['fit_time']
+        measured = '' if self.fit_time_measured else ' (per trace times estimated from the total)'
+        lines = ['Fit (%s): %.3f s in total, per trace median = %.2e s, 90%% = %.2e s, max = %.2e s%s' 
+                 %(self.hmm_engine, np.sum(t), np.median(t), np.percentile(t, 90), np.max(t), measured)]
+        if np.all(s['n_iter'] < 0):
+            lines.append('Fit iterations: not applicable')
+        else:
+            lines.append('Fit iterations: median = %d, max = %d, not converged = %d of %d' 
+                         %(np.median(s['n_iter']), np.max(s['n_iter']), np.sum(s['converged'] == 0), len(s)))
+        label = 'Slow trace' if self.fit_time_measured else 'Slow trace (estimated)'
+        for i in np.argsort(-t, kind='stable')[:n_slow]:
+            converged = {-1: 'n/a', 0: 'False', 1: 'True'}[int(s['converged'][i])]
+            n_iter = '%d iterations' %(s['n_iter'][i]) if s['n_iter'][i] >= 0 else 'no iterations'
+            lines.append('%s %d: %.2e s, %s, log likelihood = %.1f, converged = %s, snr = %.2f' 
+                         %(label, s['spot'][i], t[i], n_iter, s['log_likelihood'][i], converged, s['snr'][i]))
+        return lines
+
+
     def find_event(self):
         self.dwell_1 = [] # Bound, class 1 (pre-existing)
         self.dwell_2 = [] # Bound, class 2 (complete)
@@ -710,6 +982,101 @@ class Movie:
             f.write('dwell time (class 2, exp_pdf) = %.3f +/- %.3f [s] (N = %d) \n' %(self.dwell_pdf, self.dwell_pdf_error, len(self.dwell_2)))  
             f.write('dwell time (class 2, exp_icdf) = %.3f [s] (N = %d) \n\n' %(self.dwell_icdf, len(self.dwell_2)))  
 
+            if self.hmm_engine in ['pooled', 'warm', 'fixed']:
+                f.write('HMM transmat (%s) = [[%.5f, %.5f], [%.5f, %.5f]] \n' %((self.hmm_engine,) + tuple(self.hmm_transmat.ravel())))
+                f.write('dwell time (HMM %s) = %.3f [s] \n' %(self.hmm_engine, self.time_interval/self.hmm_transmat[1,0]))
+                f.write('wait time (HMM %s) = %.3f [s] \n\n' %(self.hmm_engine, self.time_interval/self.hmm_transmat[0,1]))
+
+            if self.hmm_cache and self.hmm_engine not in ['pooled', 'warm', 'fixed']:
+                f.write('HMM cache hits = %d, misses = %d \n\n' %(self.hmm_cache_hits, self.hmm_cache_misses))
+
+            for line in self.fit_summary():
+                f.write('%s \n' %(line))
+            f.write('\n')
+
+            if self.hmm_k_max > 0:
+                n_k = np.bincount(self.hmm_states['k'], minlength=self.hmm_k_max+1)[1:]
+                f.write('HMM states (%s) = %s \n\n' %(self.hmm_k_criterion, ', '.join('K=%d: %d' %(k+1, n) for k, n in enumerate(n_k))))
+
+            if self.drift_correct:
+                f.write('drift static = %s \n' %(self.drift_static))
+                f.write('drift clamped steps = %d \n' %(sum(self.drift_clamped)))
+                if np.any(np.isfinite(self.drift_psr)):
+                    f.write('drift peak (median) = %.3f \n' %(np.nanmedian(self.drift_peak)))
+                    f.write('drift psr (median) = %.3f \n' %(np.nanmedian(self.drift_psr)))
+                    f.write('drift frames with psr < %.1f = %d \n' %(self.drift_psr_min, sum(self.drift_psr < self.drift_psr_min)))
+                f.write('\n')
+
+            if self.coloc_image:
+                f.write('colocalized spots = %d of %d (%s) \n' %(sum(self.is_spot_coloc), self.n_spot, self.coloc_image))
+                f.write('coloc registration rmsd = %.3f [pixel] (N = %d) \n\n' %(self.coloc_rmsd, self.coloc_n_pair))
+
+        # Movie-level HMM, to be reused with hmm_engine = fixed and hmm_model = hmm_model.npz. 
+        # Only fitted models are saved, so the fixed engine never overwrites the model it loaded.
+        if self.hmm_engine in ['pooled', 'warm']:
+            save_model(Path(self.dir/'hmm_model.npz'), self.hmm_model, engine=self.hmm_engine, 
+                       name=self.name, time_interval=self.time_interval)
+
+        # Chosen number of states, evidence and state path of every spot trace (self.trace, as fitted)
+        if self.hmm_k_max > 0:
+            s = self.hmm_states
+            np.savez(Path(self.dir/'hmm_states.npz'), criterion=self.hmm_k_criterion, pooled=self.hmm_k_pooled, 
+                     k=s['k'], log_likelihood=s['log_likelihood'], bic=s['bic'], icl=s['icl'], 
+                     means=s['means'], state=s['state'].astype(np.uint8))
+
+        # State paths of the spots, run-length encoded, and the intensity of each state
+        offset, start, length, level = rle_encode(self.state)
+        np.savez_compressed(Path(self.dir/'state.npz'), n_frame=self.n_frame, offset=offset, 
+                            start=start.astype(np.int32), length=length.astype(np.int32), level=level.astype(np.uint8), 
+                            state_level=self.level, is_trace_inlier=self.is_trace_inlier)
+
+        # Per-trace fit record (engine, iterations, time, log likelihood, convergence, snr)
+        np.save(Path(self.dir/'fit_stat.npy'), self.fit_stat)
+
+        # Partner of each spot in the second channel and the transform between the channels
+        if self.coloc_image:
+            np.savez(Path(self.dir/'coloc.npz'), is_spot_coloc=self.is_spot_coloc, spot_partner=self.spot_partner, 
+                     coloc_peak=self.coloc_peak, affine=self.coloc_affine, rmsd=self.coloc_rmsd, n_pair=self.coloc_n_pair)
+
+        # Feature table of the peak traces for later stages and plots
+        np.save(Path(self.dir/'peak_feature.npy'), self.peak_feature)
+
+        # Per-frame drift and its quality for triage of batch runs
+        if self.drift_correct:
+            drift = np.column_stack((np.arange(self.n_frame), self.drift_row, self.drift_col, 
+                                     self.drift_peak, self.drift_psr, self.drift_clamped))
+            np.savetxt(Path(self.dir/'drift.txt'), drift, fmt=['%d', '%d', '%d', '%.4f', '%.4f', '%d'], 
+                       header='frame drift_row drift_col peak psr clamped')
+
+
+    def check_gate(self, stage):
+        """ Check whether the movie has enough data after a stage to go on
+        Args:
+            stage: 'peak' (after find_peak), 'spot' (after find_spot) or 'event' (after exclude_short)
+
+        Returns:
+            Reason to skip the rest of the analysis, None if the movie passes
+        """
+        if stage == 'peak' and self.n_peak < self.min_peak:
+            return '%d peaks found (min_peak = %d)' %(self.n_peak, self.min_peak)
+        if stage == 'spot' and self.n_spot < self.min_spot:
+            return '%d inlier spots found (min_spot = %d)' %(self.n_spot, self.min_spot)
+        if stage == 'event':
+            n_event = len(self.dwell_1) + len(self.dwell_2) + len(self.dwell_3)
+            if n_event < self.min_event:
+                return '%d binding events found (min_event = %d)' %(n_event, self.min_event)
+        return None
+
+
+    def save_status(self, stage, reason):
+        # Write why the movie was skipped to status.txt
+        with open(Path(self.dir/'status.txt'), "w") as f:
+            f.write('directory = %s \n' %(self.dir))
+            f.write('name = %s \n' %(self.name))
+            f.write('status = skipped \n')
+            f.write('stage = %s \n' %(stage))
+            f.write('reason = %s \n' %(reason))
+
       
     def plot0_clean(self):
         # clean all existing png files in the folder
@@ -1224,12 +1591,13 @@ class Movie:
             s = int((self.spot_size-1)/2)
             I_row = np.transpose(np.squeeze(self.I[:,r-s:r+s+1,c]))
             I_col = np.transpose(np.squeeze(self.I[:,r,c-s:c+s+1]))
+            trace_fit = self.level[i][self.state[i]] # Fit of this trace only
 
             fig, (ax1, ax2, ax3, ax4) = plt.subplots(figsize=(20, 10), ncols=1, nrows=4, dpi=300)   
 
             ax1.plot(time, self.trace[i], 'k', lw=2)
             color = ['b', 'r']
-            ax1.plot(time, self.trace_fit[i], color=color[int(self.is_trace_inlier[i])], lw=2)    
+            ax1.plot(time, trace_fit, color=color[int(self.is_trace_inlier[i])], lw=2)    
             ax1.axhline(y=self.I_u_inlier.mean(), c='k', ls='--', lw=1) 
             ax1.axhline(y=self.I_b_inlier.mean(), c='k', ls='--', lw=1)     
             ax1.set_ylim([0, 1.5*self.I_b_inlier.mean()])                        
@@ -1241,7 +1609,7 @@ class Movie:
                 title_sp = 'Data (K), Fit: Outlier (B)'
             ax1.set_title(title_sp)
 
-            ax2.plot(time, self.trace[i]-self.trace_fit[i], 'k', lw=2)        
+            ax2.plot(time, self.trace[i]-trace_fit, 'k', lw=2)        
             ax2.axhline(y=0, c='k', ls='-', lw=1)      
             ax2.axhline(y=max(self.rmsd_inlier), c='k', ls='--', lw=1)                     
             ax2.axhline(y=-max(self.rmsd_inlier), c='k', ls='--', lw=1)    
@@ -1269,6 +1637,20 @@ class Movie:
 
 
                     
+def skip_movie(movie, stage):
+    # Check the gate after a stage. If the movie fails, record why in status.txt and remove old results.
+    reason = movie.check_gate(stage)
+    if reason is None:
+        return False
+    print('\nSkipped after %s: %s\n' %(stage, reason))
+    movie.save_status(stage, reason)
+    for name in ['result.txt', 'error.txt']:
+        file = Path(movie.dir/name)
+        if file.exists():
+            os.remove(file)
+    return True
+
+
 def main():
     # Calculate the process time for each movie
     start = timer() 
@@ -1294,12 +1676,23 @@ def main():
                 print('\ninfo.txt does not exist.\n')
                 continue
 
+            # Pass the second channel image of a two-color movie, read with the movie by colocalize_spot
+            if movie_path.name == read_info(info_file).get('coloc_image'):
+                print('\nSecond channel image (coloc_image).\n')
+                continue
+
             # Pass this movie if result.txt already exists and pass_with_result == True 
             result_file = Path(movie_path.parent/'result.txt')
             if result_file.exists() and pass_with_result:
                 print('\nresult.txt already exist.\n')
                 continue  
 
+            # Pass this movie if it was skipped before (status.txt) and pass_with_result == True 
+            status_file = Path(movie_path.parent/'status.txt')
+            if status_file.exists() and pass_with_result:
+                print('\nstatus.txt already exist.\n')
+                continue  
+
 
 
 
@@ -1320,9 +1713,17 @@ def main():
 
             # Find peaks where molecules bind
             movie.find_peak()
+            if skip_movie(movie, 'peak'):
+                continue
 
             # Find spots showing good signal to noise
             movie.find_spot()
+            if skip_movie(movie, 'spot'):
+                continue
+
+            # Find the spots with a partner in the second channel (two-color movies)
+            if movie.coloc_image:
+                movie.colocalize_spot()
 
             # Fit spots
             movie.fit_spot()          
@@ -1332,6 +1733,8 @@ def main():
 
             # Exclude short events
             movie.exclude_short()
+            if skip_movie(movie, 'event'):
+                continue
 
             # Exclude long events
             movie.exclude_long()
@@ -1358,10 +1761,11 @@ def main():
             movie.plot11_dwell()
 #            movie.plot_trace_fit() 
 
-            # Delete error.txt if existing 
-            error_file = Path(movie_path.parent/'error.txt')
-            if error_file.exists():
-                os.remove(error_file)
+            # Delete error.txt and status.txt if existing 
+            for name in ['error.txt', 'status.txt']:
+                file = Path(movie_path.parent/name)
+                if file.exists():
+                    os.remove(file)
 
         except:
             # Delete result.txt if existing 
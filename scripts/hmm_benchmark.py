@@ -0,0 +1,79 @@
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+Benchmark of the HMM engines of fit_spot
+
+Simulated two-state traces are fitted by hmmlearn (one GaussianHMM per trace), the batched
+NumPy engine (apc_hmm) and the compiled two-state kernels (apc_hmm_kernels), all started
+from the same parameters. The run time and the agreement with hmmlearn are printed.
+
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+
+from __future__ import division, print_function, absolute_import
+import numpy as np
+import sys
+import warnings
+from pathlib import Path  
+from timeit import default_timer as timer
+from hmmlearn import hmm
+from inspect import currentframe, getframeinfo
+fname = getframeinfo(currentframe()).filename # current file name
+current_dir = Path(fname).resolve().parent
+sys.path.append(str(current_dir.parent/'apc'/'apc'))
+from apc_hmm import fit_traces
+from apc_hmm_kernels import fit_traces_k2, has_numba
+from conftest import param, simulate_traces
+
+# User input ----------------------------------------------------------------
+
+n_spot = 500
+n_frame = 500
+noise = 10
+seed = 0
+
+# ---------------------------------------------------------------------------
+
+
+def fit_hmmlearn(X, startprob, transmat, means, covars):
+    # One GaussianHMM per trace, started from the given parameters
+    state = np.zeros(X.shape, dtype=int)
+    mean = np.zeros((len(X), 2))
+    for i, trace in enumerate(X):
+        remodel = hmm.GaussianHMM(n_components=2, covariance_type="full", n_iter=100, init_params='')
+        remodel.startprob_ = startprob
+        remodel.transmat_ = transmat
+        remodel.means_ = means.reshape(2, 1)
+        remodel.covars_ = covars.reshape(2, 1, 1)
+        remodel.fit(trace.reshape(-1, 1))
+        Z = remodel.predict(trace.reshape(-1, 1))
+        mu = remodel.means_.ravel()
+        if mu[0] > mu[1]:
+            Z = 1 - Z
+            mu = mu[::-1]
+        state[i] = Z
+        mean[i] = mu
+    return state, mean
+
+
+def main():
+    warnings.filterwarnings('ignore')
+    # Two-state traces with a random bound intensity per spot
+    X, _ = simulate_traces(n_spot, n_frame, noise, (30., 80.), seed)
+    startprob, transmat, means = param['startprob'], param['transmat'], param['means']
+    covars = np.array([noise**2, noise**2])
+    print('%d traces x %d frames, numba = %s' %(n_spot, n_frame, has_numba))
+
+    start = timer()
+    state_ref, mean_ref = fit_hmmlearn(X, startprob, transmat, means, covars)
+    time_ref = timer() - start
+    print('hmmlearn: %.2f s' %(time_ref))
+
+    fit_traces_k2(X[:2], startprob, transmat, means, covars) # Compile the kernels
+    for name, fit in [('batch', fit_traces), ('numba', fit_traces_k2)]:
+        start = timer()
+        model, state, _ = fit(X, startprob, transmat, means, covars, n_iter=100)
+        t = timer() - start
+        print('%s: %.2f s (x%.1f), state agreement = %.6f, max mean difference = %.2e' 
+              %(name, t, time_ref/t, np.mean(state == state_ref), np.max(np.abs(model['means'] - mean_ref))))
+
+
+if __name__ == "__main__":
+    main()
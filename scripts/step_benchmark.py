@@ -0,0 +1,78 @@
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+Benchmark of the step detection engines of fit_spot against the HMM
+
+Simulated two-state traces, or the spot traces of the movies given on the command line,
+are fitted by the compiled two-state HMM (apc_hmm_kernels) and by each step detection
+engine (apc_step). The run time, the fraction of frames in the same state as the HMM
+and the median difference of the bound intensity are printed for each engine.
+
+Usage: python step_benchmark.py [movie.tif ...]
+
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+
+from __future__ import division, print_function, absolute_import
+import numpy as np
+import sys
+import warnings
+from pathlib import Path  
+from timeit import default_timer as timer
+from inspect import currentframe, getframeinfo
+fname = getframeinfo(currentframe()).filename # current file name
+current_dir = Path(fname).resolve().parent
+sys.path.append(str(current_dir.parent/'apc'/'apc'))
+from apc_hmm_kernels import fit_traces_k2
+from apc_step import fit_traces_step, step_engines
+from conftest import param, simulate_traces
+
+# User input ----------------------------------------------------------------
+
+n_spot = 50
+n_frame = 500
+noise = 10
+seed = 0
+engines = list(step_engines)
+
+# ---------------------------------------------------------------------------
+
+
+def movie_traces(path):
+    # Spot traces and initial HMM parameters of a movie, through find_spot of apc_analysis
+    from apc_analysis import Movie
+    movie = Movie(Path(path))
+    for stage in ['read_movie', 'correct_offset', 'correct_flatfield', 'correct_drift', 'find_peak', 'find_spot']:
+        getattr(movie, stage)()
+    I = movie.I_param
+    startprob = np.array([I[2], I[5]])/(I[2] + I[5])
+    return movie.trace, startprob, np.array([I[0], I[3]]), np.array([I[1], I[4]])
+
+
+def compare(X, startprob, means, covars):
+    transmat = param['transmat']
+    fit_traces_k2(X[:2], startprob, transmat, means, covars) # Compile the kernels
+    start = timer()
+    model, state_ref, _ = fit_traces_k2(X, startprob, transmat, means, covars, n_iter=100)
+    time_ref = timer() - start
+    print('%d traces x %d frames, HMM: %.2f s (%.2e s per trace)' %(X.shape + (time_ref, time_ref/len(X))))
+
+    for engine in engines:
+        start = timer()
+        fit = fit_traces_step(X, engine)
+        t = timer() - start
+        print('%s (param = %g): %.2f s (%.2e s per trace, x%.3g), state agreement = %.4f, median I_b difference = %.2f' 
+              %(engine, step_engines[engine][1], t, t/len(X), time_ref/t, np.mean(fit['state'] == state_ref), 
+                np.median(np.abs(fit['I_b'] - model['means'][:,1]))))
+
+
+def main():
+    warnings.filterwarnings('ignore')
+    if len(sys.argv) > 1:
+        for path in sys.argv[1:]:
+            print(path)
+            compare(*movie_traces(path))
+    else:
+        compare(simulate_traces(n_spot, n_frame, noise, (30., 80.), seed)[0], param['startprob'], 
+                param['means'], np.array([noise**2, noise**2]))
+
+
+if __name__ == "__main__":
+    main()